@@ -0,0 +1,225 @@
+'''
+Activity analytics over the pixel diff store built by makegif.py: which pixels changed most, when they last changed,
+edits per time bucket and colour share over time, for any region and time window
+
+Usage:
+    > analytics.py heatmap --region 400 400 600 600 --top 10
+    > analytics.py histogram --start 1491000000 --end 1491100000 --bucket 600 --by-colour
+'''
+import makegif
+import numpy
+import csv
+import argparse
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(prog='analytics.py', description="Heatmaps and time series of r/place activity, run makegif.py first to build the pixel diff store")
+
+    parser.add_argument("query", choices=["heatmap", "last-change", "histogram", "colours"],
+                        help="heatmap: PNG of how often each pixel changed, last-change: PNG of when each pixel last changed, " +
+                             "histogram: CSV of edits per bucket, colours: CSV of how many pixels show each colour at the end of each bucket.")
+    parser.add_argument("--region", nargs=4, type = int, metavar=("X1", "Y1", "X2", "Y2"), default=[1, 1, makegif.board_size, makegif.board_size],
+                        help="Region to look at, valid values: 1-1000, default: the whole board.")
+    parser.add_argument("--start", type = int, help="Epoch timestamp the window starts at, default: " + str(makegif.min_timestamp) + ".", default=makegif.min_timestamp)
+    parser.add_argument("--end", type = int, help="Epoch timestamp the window ends at, default: " + str(makegif.max_timestamp) + ".", default=makegif.max_timestamp)
+    parser.add_argument("--bucket", type = int, help="Seconds per bucket for histogram and colours, default: 60.", default=60)
+    parser.add_argument("--by-colour", help="Split the histogram into a column per colour.", action="store_true")
+    parser.add_argument("--top", type = int, help="Also print this many of the most changed pixels.", default=0)
+    parser.add_argument("--enlarge", type = int, help="Enlarge heatmaps by a whole number factor, default: 1.", default=1)
+    parser.add_argument("--out", help="File to write, default: <query>_<x1>_<y1>_<x2>_<y2>.png or .csv.")
+
+    return parser.parse_args()
+
+def GetHeatPalette():
+    #256 colour ramp for heatmaps, black through red and yellow to white
+    ramp = numpy.linspace(0, 3, 256)
+    return (numpy.clip(numpy.column_stack((ramp, ramp - 1, ramp - 2)), 0, 1) * 255).astype(numpy.uint8)
+
+class RegionActivity:
+    #every diff for a region up to the end of a time window, taken straight from the pixel-major store arrays so
+    #each pixel's diffs are together and in time order. Pixels are numbered [y, x] within the region like a canvas,
+    #so per pixel results reshape straight into an image. previous_colours is what each diff painted over
+    def __init__(self, x1, y1, x2, y2, start_timestamp, end_timestamp, pixels, timestamps, colours, previous_colours, base_colours):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = end_timestamp
+        self.pixels = pixels
+        self.timestamps = timestamps
+        self.colours = colours
+        self.previous_colours = previous_colours
+        self.base_colours = base_colours
+        self.in_window = timestamps >= start_timestamp
+
+    def getShape(self):
+        return (self.y2 - self.y1 + 1, self.x2 - self.x1 + 1)
+
+    def getNumberOfBuckets(self, bucket_seconds):
+        if bucket_seconds <= 0:
+            raise ValueError("Bucket has to be a positive number of seconds")
+        return (self.end_timestamp - self.start_timestamp) // bucket_seconds + 1
+
+    def getBuckets(self, bucket_seconds):
+        #bucket number of each diff in the window
+        return (self.timestamps[self.in_window].astype(numpy.int64) - self.start_timestamp) // bucket_seconds
+
+    def getBucketTimestamps(self, bucket_seconds):
+        return self.start_timestamp + numpy.arange(self.getNumberOfBuckets(bucket_seconds), dtype=numpy.int64) * bucket_seconds
+
+    def getChangeCounts(self):
+        #number of diffs in the window for each pixel
+        return numpy.bincount(self.pixels[self.in_window], minlength=self.base_colours.size).reshape(self.getShape())
+
+    def getLastChangeTimes(self):
+        #timestamp of each pixel's last diff in the window, 0 where it didn't change
+        pixels = self.pixels[self.in_window]
+        is_last = numpy.ones(len(pixels), dtype=bool)
+        is_last[:-1] = pixels[:-1] != pixels[1:]
+
+        last_change_times = numpy.zeros(self.base_colours.size, dtype=numpy.uint32)
+        last_change_times[pixels[is_last]] = self.timestamps[self.in_window][is_last]
+        return last_change_times.reshape(self.getShape())
+
+    def getEditHistogram(self, bucket_seconds, by_colour = False):
+        #number of diffs in each bucket, with by_colour a column for each colour that was painted
+        number_of_buckets = self.getNumberOfBuckets(bucket_seconds)
+        buckets = self.getBuckets(bucket_seconds)
+        if not by_colour:
+            return numpy.bincount(buckets, minlength=number_of_buckets)
+
+        number_of_colours = len(makegif.GetColorTable())
+        return numpy.bincount(buckets * number_of_colours + self.colours[self.in_window],
+                              minlength=number_of_buckets * number_of_colours).reshape(number_of_buckets, number_of_colours)
+
+    def getColourShare(self, bucket_seconds):
+        #number of pixels showing each colour at the end of each bucket. Each diff moves one pixel from the colour it
+        #painted over to the one it painted, so the board state is the counts at the window start plus a running sum
+        number_of_buckets = self.getNumberOfBuckets(bucket_seconds)
+        number_of_colours = len(makegif.GetColorTable())
+
+        before_window = ~self.in_window
+        start_counts = (numpy.bincount(self.base_colours, minlength=number_of_colours)
+                        + numpy.bincount(self.colours[before_window], minlength=number_of_colours)
+                        - numpy.bincount(self.previous_colours[before_window], minlength=number_of_colours))
+
+        buckets = self.getBuckets(bucket_seconds) * number_of_colours
+        changes = (numpy.bincount(buckets + self.colours[self.in_window], minlength=number_of_buckets * number_of_colours)
+                   - numpy.bincount(buckets + self.previous_colours[self.in_window], minlength=number_of_buckets * number_of_colours))
+
+        return start_counts + numpy.cumsum(changes.reshape(number_of_buckets, number_of_colours), axis=0)
+
+@makegif.metrics.timed("analytics.load")
+def LoadRegionActivity(x1, y1, x2, y2, start_timestamp, end_timestamp, base_pixels, pixels_diffs):
+    #x1..y2 are 0 based like the rest of makegif.py
+    if start_timestamp > end_timestamp:
+        raise ValueError("Window has to start before it ends")
+
+    width = x2 - x1 + 1
+    height = y2 - y1 + 1
+
+    #region pixels in store order, x major, so the store is read front to back
+    xs = numpy.arange(x1, x2 + 1, dtype=numpy.int64).repeat(height)
+    ys = numpy.tile(numpy.arange(y1, y2 + 1, dtype=numpy.int64), width)
+    store_pixels = xs * makegif.board_size + ys
+    region_pixels = (ys - y1) * width + (xs - x1)
+
+    offsets = numpy.asarray(pixels_diffs.offsets)
+    run_starts = offsets[store_pixels]
+    run_lengths = offsets[store_pixels + 1] - run_starts
+
+    #every diff position for the region's pixels, one run per pixel
+    first_in_run = numpy.cumsum(run_lengths) - run_lengths
+    diff_indexes = numpy.repeat(run_starts - first_in_run, run_lengths) + numpy.arange(run_lengths.sum(), dtype=numpy.int64)
+    pixels = numpy.repeat(region_pixels, run_lengths)
+
+    timestamps = numpy.asarray(pixels_diffs.timestamps)[diff_indexes]
+    colours = numpy.asarray(pixels_diffs.colours)[diff_indexes]
+
+    base_colours = numpy.empty(width * height, dtype=numpy.uint8)
+    base_colours[region_pixels] = numpy.asarray(base_pixels)[ys, xs]
+
+    #the first diff of a pixel paints over its base colour, the rest over the diff before them
+    previous_colours = numpy.empty_like(colours)
+    previous_colours[1:] = colours[:-1]
+    has_diffs = run_lengths > 0
+    previous_colours[first_in_run[has_diffs]] = base_colours[region_pixels[has_diffs]]
+
+    #anything after the window doesn't matter
+    keep = timestamps <= end_timestamp
+    makegif.metrics.count("diffs.scanned", len(timestamps))
+
+    return RegionActivity(x1, y1, x2, y2, start_timestamp, end_timestamp, pixels[keep], timestamps[keep], colours[keep], previous_colours[keep], base_colours)
+
+def SaveHeatmap(values, outfile, enlarge = 1, log_scale = True):
+    #log scaled by default so a few heavily fought over pixels don't wash out the rest, 0 stays black
+    values = numpy.asarray(values, dtype=numpy.float64)
+    scaled = numpy.log1p(values) if log_scale else values
+    if scaled.max() > 0:
+        scaled = scaled / scaled.max()
+
+    levels = numpy.round(scaled * 255).astype(numpy.uint8)
+    makegif.GetPaletteImage(levels, enlarge, GetHeatPalette()).save(outfile, "PNG")
+
+def SaveSeries(bucket_timestamps, series, header, outfile):
+    with open(outfile, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["timestamp"] + header)
+        for bucket_timestamp, row in zip(bucket_timestamps.tolist(), series.reshape(len(bucket_timestamps), -1).tolist()):
+            writer.writerow([bucket_timestamp] + row)
+
+def GetTopPixels(activity, change_counts, number_of_pixels):
+    #[(x, y, changes)] of the most changed pixels, 1 based like the command line
+    ranked = numpy.argsort(change_counts.ravel(), kind='stable')[::-1][:number_of_pixels]
+    ys, xs = numpy.unravel_index(ranked, change_counts.shape)
+    return [(int(x) + activity.x1 + 1, int(y) + activity.y1 + 1, int(change_counts[y, x])) for x, y in zip(xs, ys)]
+
+if __name__ == '__main__':
+
+    args = ParseArgs()
+    x1, y1, x2, y2 = args.region
+
+    try:
+        makegif.ValidateArgs(x1, y1, x2, y2, args.start, 0)
+        if args.end < args.start:
+            raise ValueError("End has to be after start")
+        if args.bucket <= 0:
+            raise ValueError("Bucket has to be a positive number of seconds")
+        if args.enlarge < 1:
+            raise ValueError("Enlarge factor has to be 1 or more")
+    except ValueError as error:
+        exit("Argument not valid: " + str(error))
+
+    try:
+        base_pixels = makegif.LoadBasePixelsIntoMemory()
+        pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    except ValueError as error:
+        exit(str(error) + ", run makegif.py first")
+
+    #-1 for array index
+    activity = LoadRegionActivity(x1 - 1, y1 - 1, x2 - 1, y2 - 1, args.start, args.end, base_pixels, pixels_diffs)
+
+    name = args.query + "_" + "_".join(str(value) for value in args.region)
+    if args.query == "heatmap":
+        change_counts = activity.getChangeCounts()
+        out = args.out or name + ".png"
+        SaveHeatmap(change_counts, out, args.enlarge)
+        print("{0:,} changes to {1:,} pixels".format(int(change_counts.sum()), int((change_counts > 0).sum())))
+        for x, y, changes in GetTopPixels(activity, change_counts, args.top):
+            print("({0}, {1}): {2:,} changes".format(x, y, changes))
+    elif args.query == "last-change":
+        out = args.out or name + ".png"
+        #brighter is more recent, pixels that didn't change in the window stay black
+        last_change_times = activity.getLastChangeTimes().astype(numpy.int64)
+        SaveHeatmap(numpy.where(last_change_times > 0, last_change_times - args.start + 1, 0), out, args.enlarge, False)
+    elif args.query == "histogram":
+        out = args.out or name + ".csv"
+        header = [str(colour) for colour in range(len(makegif.GetColorTable()))] if args.by_colour else ["edits"]
+        SaveSeries(activity.getBucketTimestamps(args.bucket), activity.getEditHistogram(args.bucket, args.by_colour), header, out)
+    else:
+        out = args.out or name + ".csv"
+        SaveSeries(activity.getBucketTimestamps(args.bucket), activity.getColourShare(args.bucket),
+                   [str(colour) for colour in range(len(makegif.GetColorTable()))], out)
+
+    print("Wrote " + out)
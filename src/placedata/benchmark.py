@@ -0,0 +1,254 @@
+'''
+Benchmarks for the makegif.py pipeline, run against a synthetic archive so they don't need the real diffs.bin
+
+Usage:
+    > benchmark.py --diffs 2000000 --baseline bench.json
+'''
+from PIL import Image
+import makegif
+import export
+import numpy
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(prog='benchmark.py', description="Benchmark makegif.py against a synthetic r/place archive")
+
+    parser.add_argument("--diffs", type = int, help="Number of pixel diffs in the synthetic archive, default: 1000000.", default=1000000)
+    parser.add_argument("--hot-spots", type = int, help="Number of busy areas in the synthetic archive, default: 20.", default=20)
+    parser.add_argument("--seed", type = int, help="Random seed for the synthetic archive, default: 0.", default=0)
+    parser.add_argument("--workdir", help="Folder to build the synthetic archive and store in, default: bench_data.", default="bench_data")
+    parser.add_argument("--regenerate", help="Regenerate the synthetic archive even if it's already in the workdir.", action="store_true")
+    parser.add_argument("--stages", nargs='+', help="Only run these stages, default: all of them.", choices=[stage[0] for stage in benchmark_stages])
+    parser.add_argument("--max-memory", help="Run every stage under this memory limit like makegif.py --max-memory, e.g. 128M.")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare against.")
+    parser.add_argument("--save", help="Write this run's results to a JSON file, can be the same file as --baseline.")
+    parser.add_argument("--tolerance", type = float, help="Fraction throughput can drop or peak memory can grow by before it's a regression, default: 0.2.", default=0.2)
+
+    return parser.parse_args()
+
+def GenerateSyntheticArchive(out_dir, number_of_diffs, hot_spots = 20, seed = 0):
+    #writes a diffs.bin and base.png in the same format as the r/place archive. Diffs are spread over the whole
+    #archive timespan with most of them piled into a few hot spots of very different sizes and popularity,
+    #like the real data where a handful of pixels get fought over thousands of times
+    random = numpy.random.RandomState(seed)
+    number_of_colours = len(makegif.GetColorTable())
+
+    records = numpy.empty(number_of_diffs, dtype=makegif.diff_record_dtype)
+    records['timestamp'] = numpy.sort(random.randint(makegif.min_timestamp, makegif.max_timestamp + 1, number_of_diffs))
+    records['x'] = random.randint(0, makegif.board_size, number_of_diffs)
+    records['y'] = random.randint(0, makegif.board_size, number_of_diffs)
+    records['colour'] = random.randint(0, number_of_colours, number_of_diffs)
+
+    if hot_spots > 0:
+        centres = random.randint(0, makegif.board_size, (hot_spots, 2))
+        radii = random.randint(3, 60, hot_spots)
+        dominant_colours = random.randint(0, number_of_colours, hot_spots)
+        popularity = 1.0 / numpy.arange(1, hot_spots + 1)
+
+        in_hot_spot = numpy.flatnonzero(random.rand(number_of_diffs) < 0.7)
+        spots = random.choice(hot_spots, size=len(in_hot_spot), p=popularity / popularity.sum())
+        for axis, column in enumerate(('x', 'y')):
+            offsets = numpy.round(random.randn(len(in_hot_spot)) * radii[spots]).astype(numpy.int64)
+            records[column][in_hot_spot] = numpy.clip(centres[spots, axis] + offsets, 0, makegif.board_size - 1)
+
+        #hot spots are mostly drawn in their own colour with the odd vandal
+        keeps_colour = random.rand(len(in_hot_spot)) < 0.8
+        records['colour'][in_hot_spot[keeps_colour]] = dominant_colours[spots[keeps_colour]]
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    records.tofile(os.path.join(out_dir, "diffs.bin"))
+
+    #base board is white with a few blocks of colour, only ever using palette colours
+    board = numpy.zeros((makegif.board_size, makegif.board_size), dtype=numpy.uint8)
+    for block in range(50):
+        x, y = random.randint(0, makegif.board_size, 2)
+        width, height = random.randint(5, 100, 2)
+        board[y:y + height, x:x + width] = random.randint(0, number_of_colours)
+
+    Image.fromarray(makegif.GetPaletteArray()[board], 'RGB').save(os.path.join(out_dir, "base.png"))
+
+def BenchmarkIngestSQLite():
+    makegif.DropAllTables()
+    makegif.BuildBaseBoard()
+    makegif.PopulateSQLiteWithPixelDiffs()
+    return os.path.getsize("diffs.bin") // makegif.diff_record_dtype.itemsize
+
+def BenchmarkBuildStore():
+    makegif.BuildPixelDiffStore()
+    return len(makegif.LoadDiffPixelsIntoMemory())
+
+def BenchmarkBuildKeyframes():
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    makegif.BuildKeyframeIndex(makegif.LoadBasePixelsIntoMemory(), pixels_diffs)
+    return len(makegif.LoadKeyframeIndex())
+
+def BenchmarkLoad():
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    makegif.LoadBasePixelsIntoMemory()
+    return len(pixels_diffs)
+
+def BenchmarkLoadRegion():
+    base_pixels, pixels_diffs = makegif.LoadRegionFromSQLite(400, 400, 599, 599)
+    return len(pixels_diffs)
+
+def BenchmarkPointQuery():
+    number_of_queries = 1000000
+    random = numpy.random.RandomState(1)
+    timestamps = random.randint(makegif.min_timestamp, makegif.max_timestamp + 1, number_of_queries)
+    xs = random.randint(0, makegif.board_size, number_of_queries)
+    ys = random.randint(0, makegif.board_size, number_of_queries)
+
+    base_pixels = makegif.LoadBasePixelsIntoMemory()
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+
+    start_time = time.perf_counter()
+    makegif.GetPixelColours(timestamps, xs, ys, base_pixels, pixels_diffs)
+    return number_of_queries, time.perf_counter() - start_time
+
+def BenchmarkFrameRender():
+    number_of_frames = 20
+    base_pixels = makegif.LoadBasePixelsIntoMemory()
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+
+    start_time = time.perf_counter()
+    for timestamp in numpy.linspace(makegif.min_timestamp, makegif.max_timestamp, number_of_frames).astype(numpy.int64):
+        makegif.GetCanvasAt(int(timestamp), 0, 0, makegif.board_size - 1, makegif.board_size - 1, base_pixels, pixels_diffs)
+    return number_of_frames, time.perf_counter() - start_time
+
+def BenchmarkGifEncode():
+    number_of_frames = 500
+    base_pixels = makegif.LoadBasePixelsIntoMemory()
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    delay = (makegif.max_timestamp - makegif.min_timestamp) // number_of_frames
+
+    start_time = time.perf_counter()
+    makegif.GenerateGif(makegif.min_timestamp, number_of_frames, delay, 0, 0, makegif.board_size - 1, makegif.board_size - 1, base_pixels, pixels_diffs)
+    return number_of_frames, time.perf_counter() - start_time
+
+def BenchmarkExportTimeline():
+    export.ExportTimeline("PlaceData.timeline", makegif.LoadBasePixelsIntoMemory(), makegif.LoadDiffPixelsIntoMemory())
+    return export.TimelineReader("PlaceData.timeline").number_of_diffs
+
+#(name, function, what's counted), stages run in this order because later ones need what earlier ones build.
+#Stages that need setup before the part being timed return (items, seconds) instead of just items
+benchmark_stages = [("ingest_sqlite", BenchmarkIngestSQLite, "diffs"),
+                    ("build_store", BenchmarkBuildStore, "diffs"),
+                    ("build_keyframes", BenchmarkBuildKeyframes, "keyframes"),
+                    ("load", BenchmarkLoad, "diffs"),
+                    ("load_region", BenchmarkLoadRegion, "diffs"),
+                    ("point_query", BenchmarkPointQuery, "queries"),
+                    ("frame_render", BenchmarkFrameRender, "frames"),
+                    ("gif_encode", BenchmarkGifEncode, "frames"),
+                    ("export_timeline", BenchmarkExportTimeline, "diffs")]
+
+def RunStage(stage_index, max_memory = None):
+    #runs in its own process so the peak memory is just this stage's
+    name, stage, unit = benchmark_stages[stage_index]
+    makegif.silent = True
+    makegif.metrics.reset()
+    if max_memory is not None:
+        makegif.SetMemoryLimit(max_memory)
+
+    start_time = time.perf_counter()
+    result = stage()
+    elapsed = time.perf_counter() - start_time
+
+    if isinstance(result, tuple):
+        items, elapsed = result
+    else:
+        items = result
+
+    return { 'seconds' : elapsed,
+             'items' : items,
+             'unit' : unit,
+             'items_per_second' : items / max(elapsed, 1e-9),
+             'peak_rss_mb' : makegif.GetPeakRSS(),
+             'metrics' : makegif.metrics.snapshot() }
+
+def RunBenchmarks(stage_names = None, max_memory = None):
+    results = {}
+    for stage_index, (name, stage, unit) in enumerate(benchmark_stages):
+        if stage_names is not None and name not in stage_names:
+            continue
+
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(RunStage, (stage_index, max_memory))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        result = results[name]
+        peak = "n/a" if result['peak_rss_mb'] is None else "{0:.0f}MB".format(result['peak_rss_mb'])
+        print("{0:<16} {1:>8.2f}s {2:>14,.0f} {3}/sec  peak rss {4}".format(name, result['seconds'], result['items_per_second'], result['unit'], peak))
+        sys.stdout.flush()
+
+    return results
+
+def FindRegressions(results, baseline, tolerance):
+    #stages that got slower or bigger than the baseline by more than the tolerance
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        previous = baseline[name]
+        if result['items_per_second'] < previous['items_per_second'] * (1 - tolerance):
+            regressions.append("{0}: throughput dropped from {1:,.0f} to {2:,.0f} {3}/sec".format(name, previous['items_per_second'], result['items_per_second'], result['unit']))
+        if result['peak_rss_mb'] is not None and previous.get('peak_rss_mb') is not None and result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append("{0}: peak rss grew from {1:.0f}MB to {2:.0f}MB".format(name, previous['peak_rss_mb'], result['peak_rss_mb']))
+
+    return regressions
+
+if __name__ == '__main__':
+
+    args = ParseArgs()
+
+    #load the baseline before moving into the workdir so relative paths work
+    baseline = None
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    save_path = None if args.save is None else os.path.abspath(args.save)
+    
+    try:
+        max_memory = None if args.max_memory is None else makegif.ParseByteSize(args.max_memory)
+    except ValueError as error:
+        exit("Argument not valid: " + str(error))
+
+    if args.regenerate or not os.path.exists(os.path.join(args.workdir, "diffs.bin")):
+        print("Generating synthetic archive with " + str(args.diffs) + " diffs in " + args.workdir)
+        GenerateSyntheticArchive(args.workdir, args.diffs, args.hot_spots, args.seed)
+
+    os.chdir(args.workdir)
+
+    results = RunBenchmarks(args.stages, max_memory)
+
+    run = { 'diffs' : os.path.getsize("diffs.bin") // makegif.diff_record_dtype.itemsize,
+            'created' : time.time(),
+            'max_memory' : max_memory,
+            'stages' : results }
+
+    if save_path is not None:
+        with open(save_path, "w") as save_file:
+            json.dump(run, save_file, indent=4, sort_keys=True)
+
+    if baseline is not None:
+        if baseline.get('diffs') != run['diffs']:
+            print("Baseline was run with " + str(baseline.get('diffs')) + " diffs, not comparing")
+        elif baseline.get('max_memory') != run['max_memory']:
+            print("Baseline was run with a different --max-memory, not comparing")
+        else:
+            regressions = FindRegressions(results, baseline['stages'], args.tolerance)
+            for regression in regressions:
+                print("REGRESSION " + regression)
+            if regressions:
+                exit(1)
+            print("No regressions against " + args.baseline)
@@ -0,0 +1,309 @@
+'''
+Export the pixel diff store built by makegif.py as a tiled timeline file for Unreal Engine, and read it back
+
+The board is split into tiles and each tile's diffs are written in time order into fixed size chunks, so a reader can
+memory map the file and go straight to any tile and time window without parsing the rest. See timeline_header_dtype
+for the layout
+
+Usage:
+    > export.py --out PlaceData.timeline
+    > export.py --read PlaceData.timeline --tile 8 8 --start 1491000000 --end 1491003600 --png tile.png
+'''
+import makegif
+import numpy
+import os
+import logging
+import argparse
+
+
+timeline_magic = b"PLTL"
+timeline_format_version = 1 #bump when the layout changes, readers refuse files with a different version
+timeline_chunk_diffs = 4096 #diffs per chunk, has to be a multiple of 16 so every chunk stays 8 byte aligned
+max_timestamp_delta = 65535 #biggest gap between two diffs a chunk can hold, a longer gap starts a new chunk
+
+#little endian throughout, every section starts on an 8 byte boundary:
+#  header
+#  base board, one tile after another, tile_size * tile_size colour keys each packed two per byte, low nibble first
+#  tile table, one entry per tile in row order (tile y * tiles across + tile x)
+#  chunks, each tile's chunks one after another in time order, chunk_diffs fixed so chunk n is at chunks_offset + n * size
+#  chunk index, the first timestamp of every chunk so a time window can be found without touching the chunks
+timeline_header_dtype = numpy.dtype([('magic', 'S4'), ('version', '<u4'), ('board_size', '<u4'), ('tile_size', '<u4'),
+                                     ('chunk_diffs', '<u4'), ('number_of_tiles', '<u4'), ('number_of_chunks', '<u4'), ('number_of_diffs', '<u4'),
+                                     ('base_offset', '<u8'), ('tiles_offset', '<u8'), ('chunks_offset', '<u8'), ('chunk_index_offset', '<u8')])
+timeline_tile_dtype = numpy.dtype([('first_chunk', '<u4'), ('number_of_chunks', '<u4'), ('number_of_diffs', '<u4'), ('last_timestamp', '<u4')])
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(prog='export.py', description="Export r/place as a tiled timeline file for Unreal Engine, run makegif.py first to build the pixel diff store")
+
+    parser.add_argument("--out", help="Timeline file to write, default: PlaceData.timeline.", default="PlaceData.timeline")
+    parser.add_argument("--tile-size", type = int, help="Width and height of a tile in pixels, even and at most 256, default: " + str(makegif.tile_size) + ".", default=makegif.tile_size)
+    parser.add_argument("--chunk-diffs", type = int, help="Diffs per chunk, a multiple of 16, default: " + str(timeline_chunk_diffs) + ".", default=timeline_chunk_diffs)
+    parser.add_argument("--silent", help="Don't display progress bars.", action="store_true")
+    parser.add_argument("--read", help="Read a timeline file instead of writing one, prints the diffs of a tile in a time window.")
+    parser.add_argument("--tile", nargs=2, type = int, metavar=("TX", "TY"), default=[0, 0], help="Tile to read, default: 0 0.")
+    parser.add_argument("--start", type = int, help="Epoch timestamp the window starts at, default: " + str(makegif.min_timestamp) + ".", default=makegif.min_timestamp)
+    parser.add_argument("--end", type = int, help="Epoch timestamp the window ends at, default: " + str(makegif.max_timestamp) + ".", default=makegif.max_timestamp)
+    parser.add_argument("--png", help="Also save the tile as it was at the end of the window to this PNG.")
+
+    return parser.parse_args()
+
+def AlignOffset(offset, alignment = 8):
+    return -(-offset // alignment) * alignment
+
+def GetChunkDtype(chunk_diffs):
+    #deltas are the seconds since the diff before, the first diff's delta is from first_timestamp so it's always 0.
+    #pixels are y * tile_size + x within the tile, colours are packed two per byte low nibble first. Slots past count are 0
+    return numpy.dtype([('first_timestamp', '<u4'), ('count', '<u4'), ('deltas', '<u2', (chunk_diffs,)),
+                        ('pixels', '<u2', (chunk_diffs,)), ('colours', 'u1', (chunk_diffs // 2,))])
+
+def GetTileBounds(tile_x, tile_y, tile_size):
+    #0 based x1, y1, x2, y2 of a tile, tiles on the right and bottom edge are cut off by the board
+    x1 = tile_x * tile_size
+    y1 = tile_y * tile_size
+    return x1, y1, min(x1 + tile_size, makegif.board_size) - 1, min(y1 + tile_size, makegif.board_size) - 1
+
+def PackColours(colours):
+    #(..., n) colour keys to (..., n / 2) bytes, low nibble first
+    return colours[..., 0::2] | (colours[..., 1::2] << 4)
+
+def UnpackColours(packed):
+    colours = numpy.empty(packed.shape[:-1] + (packed.shape[-1] * 2,), dtype=numpy.uint8)
+    colours[..., 0::2] = packed & 0x0F
+    colours[..., 1::2] = packed >> 4
+    return colours
+
+def PackBaseTiles(base_pixels, tile_size):
+    #every tile of the base board in tile table order, padded out to tile_size x tile_size
+    tiles_across = -(-makegif.board_size // tile_size)
+    padded = numpy.zeros((tiles_across * tile_size, tiles_across * tile_size), dtype=numpy.uint8)
+    padded[:makegif.board_size, :makegif.board_size] = base_pixels
+    tiles = padded.reshape(tiles_across, tile_size, tiles_across, tile_size).transpose(0, 2, 1, 3)
+    return PackColours(tiles.reshape(tiles_across * tiles_across, tile_size * tile_size))
+
+def GetTileDiffs(tile_x, tile_y, tile_size, pixels_diffs):
+    #(timestamps, pixels, colours) of every diff in a tile in time order, pixels numbered within the tile. The store is
+    #pixel major with x outermost, so each column of the tile is one contiguous run of it
+    x1, y1, x2, y2 = GetTileBounds(tile_x, tile_y, tile_size)
+    column_offsets = numpy.asarray(pixels_diffs.offsets[x1 * makegif.board_size + y1:x2 * makegif.board_size + y2 + 2]).astype(numpy.int64)
+
+    timestamps = []
+    pixels = []
+    colours = []
+    for x in range(x1, x2 + 1):
+        first = (x - x1) * makegif.board_size
+        run_ends = column_offsets[first:first + y2 - y1 + 2]
+        start, end = int(run_ends[0]), int(run_ends[-1])
+
+        timestamps.append(numpy.asarray(pixels_diffs.timestamps[start:end]))
+        colours.append(numpy.asarray(pixels_diffs.colours[start:end]))
+        pixels.append(numpy.repeat(numpy.arange(y2 - y1 + 1, dtype=numpy.uint16) * tile_size + (x - x1), numpy.diff(run_ends)))
+
+    timestamps = numpy.concatenate(timestamps)
+
+    #stable so diffs to the same pixel in the same second stay in the order they were made
+    order = numpy.argsort(timestamps, kind='stable')
+    return timestamps[order], numpy.concatenate(pixels)[order], numpy.concatenate(colours)[order]
+
+def EncodeTileChunks(timestamps, pixels, colours, chunk_dtype):
+    chunk_diffs = chunk_dtype['deltas'].shape[0]
+    if len(timestamps) == 0:
+        return numpy.zeros(0, dtype=chunk_dtype)
+
+    deltas = numpy.diff(timestamps.astype(numpy.int64), prepend=int(timestamps[0]))
+
+    #a new chunk every chunk_diffs diffs, or sooner if the gap to the next diff doesn't fit in 16 bits
+    segment_starts = numpy.concatenate(([0], numpy.flatnonzero(deltas > max_timestamp_delta)))
+    segment_ends = numpy.append(segment_starts[1:], len(timestamps))
+    chunk_starts = numpy.concatenate([numpy.arange(start, end, chunk_diffs) for start, end in zip(segment_starts, segment_ends)])
+    chunk_counts = numpy.diff(numpy.append(chunk_starts, len(timestamps)))
+
+    chunk_of_diff = numpy.repeat(numpy.arange(len(chunk_starts)), chunk_counts)
+    slots = numpy.arange(len(timestamps)) - chunk_starts[chunk_of_diff]
+    deltas[chunk_starts] = 0
+
+    chunks = numpy.zeros(len(chunk_starts), dtype=chunk_dtype)
+    chunks['first_timestamp'] = timestamps[chunk_starts]
+    chunks['count'] = chunk_counts
+    chunks['deltas'][chunk_of_diff, slots] = deltas
+    chunks['pixels'][chunk_of_diff, slots] = pixels
+
+    chunk_colours = numpy.zeros((len(chunk_starts), chunk_diffs), dtype=numpy.uint8)
+    chunk_colours[chunk_of_diff, slots] = colours
+    chunks['colours'] = PackColours(chunk_colours)
+
+    return chunks
+
+@makegif.metrics.timed("export.timeline")
+def ExportTimeline(out_path, base_pixels, pixels_diffs, tile_size = makegif.tile_size, chunk_diffs = timeline_chunk_diffs):
+    #streams the store out one tile at a time, so memory is bounded by the busiest tile rather than the whole archive.
+    #Chunks are written as they're encoded, the header and tile table go in last once the chunk counts are known
+    if tile_size < 2 or tile_size > 256 or tile_size % 2 != 0:
+        raise ValueError("Tile size has to be an even number up to 256")
+    if chunk_diffs < 16 or chunk_diffs % 16 != 0:
+        raise ValueError("Chunk size has to be a multiple of 16 diffs")
+
+    logging.info("Started exporting timeline: " + out_path)
+
+    tiles_across = -(-makegif.board_size // tile_size)
+    number_of_tiles = tiles_across * tiles_across
+    chunk_dtype = GetChunkDtype(chunk_diffs)
+
+    header = numpy.zeros(1, dtype=timeline_header_dtype)
+    header['magic'] = timeline_magic
+    header['version'] = timeline_format_version
+    header['board_size'] = makegif.board_size
+    header['tile_size'] = tile_size
+    header['chunk_diffs'] = chunk_diffs
+    header['number_of_tiles'] = number_of_tiles
+    header['base_offset'] = AlignOffset(timeline_header_dtype.itemsize)
+    header['tiles_offset'] = AlignOffset(int(header['base_offset'][0]) + number_of_tiles * tile_size * tile_size // 2)
+    header['chunks_offset'] = AlignOffset(int(header['tiles_offset'][0]) + number_of_tiles * timeline_tile_dtype.itemsize)
+
+    tiles = numpy.zeros(number_of_tiles, dtype=timeline_tile_dtype)
+    chunk_first_timestamps = []
+    number_of_chunks = 0
+
+    bar = makegif.ProgressBarWrapper("Exporting tiles: ", 1, number_of_tiles)
+
+    temp_path = out_path + ".tmp"
+    with open(temp_path, "wb") as timeline_file:
+        timeline_file.seek(int(header['chunks_offset'][0]))
+        for tile in range(number_of_tiles):
+            timestamps, pixels, colours = GetTileDiffs(tile % tiles_across, tile // tiles_across, tile_size, pixels_diffs)
+            chunks = EncodeTileChunks(timestamps, pixels, colours, chunk_dtype)
+            timeline_file.write(chunks.tobytes())
+
+            tiles[tile] = (number_of_chunks, len(chunks), len(timestamps), timestamps[-1] if len(timestamps) else 0)
+            chunk_first_timestamps.append(chunks['first_timestamp'].copy())
+            number_of_chunks += len(chunks)
+            makegif.metrics.count("diffs.exported", len(timestamps))
+            bar.update()
+
+        header['number_of_chunks'] = number_of_chunks
+        header['number_of_diffs'] = int(tiles['number_of_diffs'].sum())
+        header['chunk_index_offset'] = int(header['chunks_offset'][0]) + number_of_chunks * chunk_dtype.itemsize
+        timeline_file.write(numpy.concatenate(chunk_first_timestamps).astype('<u4').tobytes())
+
+        timeline_file.seek(0)
+        timeline_file.write(header.tobytes())
+        timeline_file.seek(int(header['base_offset'][0]))
+        timeline_file.write(PackBaseTiles(base_pixels, tile_size).tobytes())
+        timeline_file.seek(int(header['tiles_offset'][0]))
+        timeline_file.write(tiles.tobytes())
+
+    os.replace(temp_path, out_path)
+    bar.finish()
+
+    makegif.metrics.count("bytes.timeline", os.path.getsize(out_path))
+    logging.info("Finished exporting timeline: " + str(number_of_chunks) + " chunks for " + str(number_of_tiles) + " tiles")
+
+class TimelineReader:
+    #reference reader for timeline files. The file is memory mapped and only the header is parsed, tiles, chunks and the
+    #chunk index are views straight onto the map so a window only pages in the chunks it decodes
+    def __init__(self, path):
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        if len(self.data) < timeline_header_dtype.itemsize:
+            raise ValueError(path + " is too short to be a timeline file")
+
+        header = numpy.frombuffer(self.data, dtype=timeline_header_dtype, count=1)[0]
+        if header['magic'] != timeline_magic:
+            raise ValueError(path + " is not a timeline file")
+        if header['version'] != timeline_format_version:
+            raise ValueError(path + " is timeline version " + str(header['version']) + ", this reader reads version " + str(timeline_format_version))
+
+        self.board_size = int(header['board_size'])
+        self.tile_size = int(header['tile_size'])
+        self.tiles_across = -(-self.board_size // self.tile_size)
+        self.number_of_chunks = int(header['number_of_chunks'])
+        self.number_of_diffs = int(header['number_of_diffs'])
+
+        number_of_tiles = int(header['number_of_tiles'])
+        self.base_tiles = numpy.frombuffer(self.data, dtype=numpy.uint8, count=number_of_tiles * self.tile_size * self.tile_size // 2,
+                                           offset=int(header['base_offset'])).reshape(number_of_tiles, -1)
+        self.tiles = numpy.frombuffer(self.data, dtype=timeline_tile_dtype, count=number_of_tiles, offset=int(header['tiles_offset']))
+        self.chunks = numpy.frombuffer(self.data, dtype=GetChunkDtype(int(header['chunk_diffs'])), count=self.number_of_chunks,
+                                       offset=int(header['chunks_offset']))
+        self.chunk_first_timestamps = numpy.frombuffer(self.data, dtype='<u4', count=self.number_of_chunks, offset=int(header['chunk_index_offset']))
+
+    def getTile(self, tile_x, tile_y):
+        if not (0 <= tile_x < self.tiles_across and 0 <= tile_y < self.tiles_across):
+            raise ValueError("Tiles go from 0 to " + str(self.tiles_across - 1))
+        return tile_y * self.tiles_across + tile_x
+
+    def getBaseTile(self, tile_x, tile_y):
+        #the tile's base colours as a canvas, cut down to the board at the edges
+        x1, y1, x2, y2 = GetTileBounds(tile_x, tile_y, self.tile_size)
+        canvas = UnpackColours(self.base_tiles[self.getTile(tile_x, tile_y)]).reshape(self.tile_size, self.tile_size)
+        return canvas[:y2 - y1 + 1, :x2 - x1 + 1]
+
+    def getTileDiffs(self, tile_x, tile_y, start_timestamp = makegif.min_timestamp, end_timestamp = makegif.max_timestamp):
+        #(timestamps, pixels, colours) of the tile's diffs from start_timestamp to end_timestamp inclusive, in time order,
+        #pixels numbered y * tile_size + x within the tile. Only the chunks overlapping the window are decoded
+        tile = self.tiles[self.getTile(tile_x, tile_y)]
+        first_chunk = int(tile['first_chunk'])
+        first_timestamps = self.chunk_first_timestamps[first_chunk:first_chunk + int(tile['number_of_chunks'])]
+
+        #the last chunk starting before the window can still have diffs in it
+        start = max(int(numpy.searchsorted(first_timestamps, start_timestamp, side='left')) - 1, 0)
+        end = int(numpy.searchsorted(first_timestamps, end_timestamp, side='right'))
+        chunks = self.chunks[first_chunk + start:first_chunk + end]
+        makegif.metrics.count("chunks.decoded", len(chunks))
+
+        chunk_diffs = chunks.dtype['deltas'].shape[0]
+        in_chunk = numpy.arange(chunk_diffs) < chunks['count'][:, None]
+        timestamps = (chunks['first_timestamp'][:, None].astype(numpy.int64) + numpy.cumsum(chunks['deltas'], axis=1, dtype=numpy.int64))[in_chunk]
+        pixels = chunks['pixels'][in_chunk]
+        colours = UnpackColours(chunks['colours'])[in_chunk]
+
+        in_window = (timestamps >= start_timestamp) & (timestamps <= end_timestamp)
+        return timestamps[in_window].astype(numpy.uint32), pixels[in_window], colours[in_window]
+
+    def getTileAt(self, tile_x, tile_y, timestamp):
+        #canvas of the tile as it was at a timestamp, the base tile with every diff up to then painted on
+        canvas = numpy.zeros((self.tile_size, self.tile_size), dtype=numpy.uint8)
+        canvas.flat[:] = UnpackColours(self.base_tiles[self.getTile(tile_x, tile_y)])
+        timestamps, pixels, colours = self.getTileDiffs(tile_x, tile_y, 0, timestamp)
+
+        #only the last diff of each pixel counts
+        reversed_pixels, reversed_first = numpy.unique(pixels[::-1], return_index=True)
+        canvas.flat[reversed_pixels] = colours[::-1][reversed_first]
+
+        x1, y1, x2, y2 = GetTileBounds(tile_x, tile_y, self.tile_size)
+        return canvas[:y2 - y1 + 1, :x2 - x1 + 1]
+
+if __name__ == '__main__':
+
+    args = ParseArgs()
+    makegif.silent = args.silent
+
+    FORMAT = '%(asctime)s - %(message)s'
+    logging.basicConfig(format=FORMAT, filename='place_data.log', level=logging.INFO)
+
+    if args.read is not None:
+        try:
+            reader = TimelineReader(args.read)
+            tile_x, tile_y = args.tile
+            timestamps, pixels, colours = reader.getTileDiffs(tile_x, tile_y, args.start, args.end)
+        except (ValueError, IOError) as error:
+            exit("Can't read timeline: " + str(error))
+
+        print("Tile ({0}, {1}): {2:,} diffs from {3} to {4}".format(tile_x, tile_y, len(timestamps), args.start, args.end))
+        if args.png is not None:
+            makegif.SaveCanvasAsPNG(reader.getTileAt(tile_x, tile_y, args.end), args.png)
+            print("Wrote " + args.png)
+        exit()
+
+    try:
+        base_pixels = makegif.LoadBasePixelsIntoMemory()
+        pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    except ValueError as error:
+        exit(str(error) + ", run makegif.py first")
+
+    try:
+        ExportTimeline(args.out, base_pixels, pixels_diffs, args.tile_size, args.chunk_diffs)
+    except ValueError as error:
+        exit("Argument not valid: " + str(error))
+
+    makegif.metrics.log()
+    print("Wrote " + args.out)
@@ -3,23 +3,74 @@ Created on 4 Apr 2017
 
 @author: FlakeGunner
 '''
-from PIL import Image
-from collections import defaultdict
 import sqlite3
 import struct
-import datetime
 import os
-import tempfile
-import imageio
 import logging
 import argparse
-import progressbar
 import sys
 import textwrap
+import multiprocessing
+import time
+import json
+import functools
+import hashlib
+import io
+import queue
+import threading
+import collections
+import numpy
+
+try:
+    import resource
+except ImportError:
+    #no rusage on windows, peak memory isn't sampled there
+    resource = None
 
 min_timestamp = 1490986860 #we don't have data before this timestamp
 max_timestamp = 1491238721 #timestamp when r/place finished
 
+#diffs.bin is a flat array of little endian (timestamp, x, y, colour) uint32 records
+diff_record_dtype = numpy.dtype([('timestamp', '<u4'), ('x', '<u4'), ('y', '<u4'), ('colour', '<u4')])
+region_diff_dtype = numpy.dtype([('seq', '<u4'), ('timestamp', '<u4'), ('pixel', '<u4'), ('colour', '<u1')]) #a diff loaded from SQLite for a region
+ingest_batch_size = 1000000 #number of diff records written per executemany call
+ingest_queue_batches = 2 #batches sorted and ready to insert while SQLite writes the one before, bounds how far ahead sorting gets
+
+board_size = 1000 #r/place is 1000 x 1000 pixels
+tile_size = 50 #pixel_diffs rows are clustered by tile_size x tile_size tile, then timestamp
+region_load_max_area = board_size * board_size // 4 #crops smaller than this are loaded from SQLite instead of the whole board store
+sqlite_fetch_size = 100000 #rows fetched per fetchmany call when loading a region
+base_path = "PlaceData.base.npy" #base.png as a board of colour keys, memory mapped when it's loaded
+store_path = "PlaceData.store" #directory holding the memory mapped pixel diff arrays
+manifest_path = "PlaceData.manifest.json" #what the SQLite tables, store and keyframes were built from, checked at startup
+manifest_format_version = 2 #bump when a table or store layout changes so old builds get rebuilt
+replay_chunk_size = 1000000 #max number of diffs applied to a canvas in one go, bounds temporary memory
+
+#full board snapshots are taken every keyframe_diff_interval diffs, or every keyframe_seconds_interval seconds if that's set
+#each keyframe costs 1MB on disk, closer keyframes mean less replaying when seeking to a timestamp
+keyframe_diff_interval = 250000
+keyframe_seconds_interval = None
+
+gif_frame_duration = 1000 / 60 #milliseconds each gif frame is shown for
+gif_transparent_index = 16 #first colour after the r/place palette in the gif colour table
+
+pyramid_scales = (2, 4, 8) #shrink factors --scale can take, each one is a pyramid level kept up to date during replay
+worker_chunks_per_worker = 4 #the frame timeline is split into this many contiguous chunks per worker to even out the load
+
+render_queue_chunks_per_worker = 2 #finished chunks waiting to be written out per worker, workers pause when it's full
+
+#--max-memory sizes batches, chunks and queues from what's left under the limit once the interpreter and libraries are
+#loaded, using these rough costs. Pages of memory mapped files aren't counted, the OS drops them when it needs the room
+working_memory = None #bytes each stage can use under --max-memory, None when there's no limit
+min_working_memory = 32 * 1024 * 1024
+startup_memory_estimate = 64 * 1024 * 1024 #what's in use before any work starts, where it can't be measured
+ingest_bytes_per_diff = 160 #one record, its sort order and its row of int64s while it's waiting to be inserted
+store_bytes_per_diff = 48 #building the whole store in memory, above this the store is built in batches
+store_batch_bytes_per_diff = 128 #one record while it's being scattered into place by a batched store build
+replay_bytes_per_diff = 80 #one diff of a replay chunk with the int64 coordinates and dedup temporaries
+
+silent = False #set from --silent, turns off progress bars
+
 
 def ParseArgs():   
     parser = argparse.ArgumentParser( prog='makegif.py',
@@ -43,8 +94,24 @@ def ParseArgs():
                         help='Epoch timestamp to start gif from.  r/place data starts from: ' + str(min_timestamp) + " and ends at " + str(max_timestamp) + ", default: " + str(min_timestamp) + ".", 
                         const=min_timestamp, default=min_timestamp)
     parser.add_argument("delay", nargs='?', type = int, help='Delay in seconds between snapshots/gif frames, default:60.', const=60, default=60)
+    parser.add_argument("--end", type = int, help="Epoch timestamp to end the gif at, default: " + str(max_timestamp) + ".", default=max_timestamp)
+    parser.add_argument("--schedule", choices=["fixed", "density"], default="fixed",
+                        help="fixed: a frame every delay seconds, density: frames placed by the number of edits in the region so busy stretches get more frames and quiet ones fewer, default: fixed.")
+    parser.add_argument("--frames", type = int, help="Number of frames for --schedule density, only works with it, default: as many as delay would give.")
     parser.add_argument("--silent", help="Don't display progress bars, runs a bit faster.", action="store_true")
     parser.add_argument("--enlarge", help="Enlarge gif size by 4", action="store_true")
+    parser.add_argument("--enlarge-factor", type = int, help="Enlarge gif size by a whole number factor instead of 4.")
+    parser.add_argument("--scale", type = int, choices=(1,) + pyramid_scales, default=1,
+                        help="Shrink the gif by 2, 4 or 8, each pixel is the most common colour in its block. Fast for whole board gifs, can be combined with --enlarge, default: 1.")
+    parser.add_argument("--max-memory", help="Keep memory use under this, e.g. 256M. Batches, chunks and queues get smaller to fit, runs a bit slower.")
+    parser.add_argument("--metrics", help="Write timings, counters and peak memory for each stage of the run to this JSON file.")
+    parser.add_argument("--workers", type = int, help="Number of processes to render frames with, default: 1.", default=1)
+    parser.add_argument("--delta-frames", help="Only encode the part of each gif frame that changed, makes gifs a lot smaller.", action="store_true")
+    parser.add_argument("--jobs", help="JSON file of many gifs/PNG sequences to render in one pass over the data in one process. Each job sets its own coordinates, timestamp, delay, end, frames, enlarge, scale and delta frames, so --end, --frames, --enlarge, --enlarge-factor, --scale, --delta-frames, --schedule and --workers can't be used with it.")
+    parser.add_argument("--keyframe-diffs", type = int, default=keyframe_diff_interval,
+                        help="Number of diffs between full board keyframes, each keyframe is 1MB on disk, default: " + str(keyframe_diff_interval) + ".")
+    parser.add_argument("--keyframe-seconds", type = int, default=keyframe_seconds_interval,
+                        help="Seconds between full board keyframes, overrides --keyframe-diffs when set.")
     
     return parser.parse_args()
 
@@ -69,46 +136,375 @@ def GetColorTable():
     
     return colour_reference
 
-def ColourLookupRGBToKey(rgb_tuple):
+def GetPaletteArray():
+    #palette as a (16, 3) array so a whole canvas of colour keys can be looked up in one go
     colour_reference = GetColorTable()
+    return numpy.array([colour_reference[colour_key] for colour_key in range(len(colour_reference))], dtype=numpy.uint8)
+
+def ReadBaseBoard(path = "base.png"):
+    #decode a png into a board of colour keys indexed [y, x] in one go, each pixel's packed rgb is looked up in the sorted palette
+    from PIL import Image
     
-    for colour_key, colour_value in colour_reference.items():
-        if colour_value == rgb_tuple:
-            return colour_key
-        
-    raise ValueError('Failed to lookup colour reference')
+    im = Image.open(path)
+    if im.size != (board_size, board_size):
+        raise ValueError(path + " is " + str(im.size[0]) + "x" + str(im.size[1]) + " pixels, it should be " + str(board_size) + "x" + str(board_size))
+    
+    rgb = numpy.asarray(im.convert("RGB"), dtype=numpy.uint32)
+    packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+    
+    palette = GetPaletteArray().astype(numpy.uint32)
+    palette_packed = (palette[:, 0] << 16) | (palette[:, 1] << 8) | palette[:, 2]
+    palette_order = numpy.argsort(palette_packed)
+    
+    positions = numpy.minimum(numpy.searchsorted(palette_packed[palette_order], packed), len(palette_order) - 1)
+    off_palette = palette_packed[palette_order][positions] != packed
+    if off_palette.any():
+        ys, xs = numpy.nonzero(off_palette)
+        raise ValueError(path + " has " + str(len(xs)) + " pixels that aren't r/place colours, the first is rgb " +
+                         str(tuple(rgb[ys[0], xs[0]].tolist())) + " at (" + str(xs[0] + 1) + ", " + str(ys[0] + 1) + ")")
+    
+    return palette_order[positions].astype(numpy.uint8)
+
+def EnlargeCanvas(canvas, enlarge = 1):
+    #nearest neighbour blow up, repeats every pixel enlarge times in each direction
+    if enlarge < 1:
+        raise ValueError("Enlarge factor has to be 1 or more")
+    if enlarge > 1:
+        canvas = canvas.repeat(enlarge, axis=0).repeat(enlarge, axis=1)
+    
+    return canvas
+
+def GetScaledLength(length, scale = 1):
+    #width or height of a canvas after shrinking by scale, blocks cut off by the edge still get a pixel
+    return -(-length // scale)
 
-def ColourLookupKeyToRGB(colour_key):
-    return GetColorTable()[colour_key]
+def DownsampleCanvas(canvas, scale = 1):
+    #one off shrink of a canvas, replays keep a DownsampledCanvas up to date instead
+    if scale == 1:
+        return canvas
+    return DownsampledCanvas(canvas, scale).canvas
+
+def GetPaletteImage(canvas, enlarge = 1, palette = None):
+    #'P' mode image straight from a canvas of colour keys with the r/place palette, or any other (n, 3) palette, attached
+    canvas = EnlargeCanvas(canvas, enlarge)
+    
+    from PIL import Image
+    
+    im = Image.fromarray(numpy.ascontiguousarray(canvas, dtype=numpy.uint8))
+    im.putpalette((GetPaletteArray() if palette is None else numpy.asarray(palette, dtype=numpy.uint8)).tobytes())
+    
+    return im
         
 
-class BasePixel:
-    def __init__(self, x, y, colour):
-            self.x = x
-            self.y = y
-            self.colour = colour
-    def __str__(self):
-            return "Base Pixel[ X:" + str(self.x) + " Y:" + str(self.y) + " Colour:" + str(self.colour) + "]"
+class DownsampledCanvas:
+    #a pyramid level of a canvas, each pixel is the most common colour in a scale x scale block, ties go to the lower
+    #colour key. Colour counts for every block are kept up to date as diffs are applied, so only the blocks that had
+    #pixels change are looked at again and a frame costs about the same as one at the smaller size
+    def __init__(self, canvas, scale):
+        if scale not in pyramid_scales:
+            raise ValueError("Scale has to be one of " + ", ".join(str(level) for level in pyramid_scales))
+        height, width = canvas.shape
+        self.scale = scale
+        self.number_of_colours = len(GetColorTable())
+        self.blocks_down = GetScaledLength(height, scale)
+        self.blocks_across = GetScaledLength(width, scale)
+        
+        #block number of each canvas pixel, in canvas.flat order
+        block_rows = numpy.arange(height, dtype=numpy.int32) // scale
+        block_columns = numpy.arange(width, dtype=numpy.int32) // scale
+        self.block_indexes = (block_rows[:, None] * self.blocks_across + block_columns[None, :]).ravel()
         
-    def getSQLiteInsertString(self):
-            return "(" + str(self.x) + "," + str(self.y) + "," + str(self.colour) + ")"
+        self.reset(canvas)
+    
+    def reset(self, canvas):
+        #count every block again, for keyframe jumps and big runs of diffs
+        number_of_blocks = self.blocks_down * self.blocks_across
+        self.counts = numpy.bincount(self.block_indexes * self.number_of_colours + canvas.ravel(),
+                                     minlength=number_of_blocks * self.number_of_colours).reshape(number_of_blocks, self.number_of_colours).astype(numpy.int32)
+        self.canvas = self.counts.argmax(axis=1).astype(numpy.uint8).reshape(self.blocks_down, self.blocks_across)
+    
+    def update(self, canvas, canvas_indexes, old_colours):
+        #canvas pixels at canvas_indexes have just changed from old_colours to what's in canvas now
+        if len(canvas_indexes) > self.counts.size // 4:
+            self.reset(canvas)
+            return
+        
+        blocks = self.block_indexes[canvas_indexes]
+        numpy.subtract.at(self.counts, (blocks, old_colours), 1)
+        numpy.add.at(self.counts, (blocks, canvas.flat[canvas_indexes]), 1)
+        
+        changed_blocks = numpy.unique(blocks)
+        self.canvas.flat[changed_blocks] = self.counts[changed_blocks].argmax(axis=1)
 
-class DiffPixel:
-        def __init__(self, timestamp, x, y, colour):
-            self.timestamp = timestamp;
-            self.x = x
-            self.y = y
-            self.colour = colour
+class PixelDiffStore:
+    #pixel diffs sorted by (x, y, timestamp) in flat typed arrays, the diffs for pixel (x, y)
+    #are timestamps[offsets[p]:offsets[p + 1]] where p = x * board_size + y
+    #the sweep arrays hold the same diffs in timestamp order for replaying the board
+    def __init__(self, timestamps, colours, offsets, sweep_timestamps, sweep_pixels, sweep_colours, keyframes = None):
+        self.timestamps = timestamps
+        self.colours = colours
+        self.offsets = offsets
+        self.sweep_timestamps = sweep_timestamps
+        self.sweep_pixels = sweep_pixels
+        self.sweep_colours = sweep_colours
+        self.keyframes = keyframes
+        self.path = None #set when the arrays are memory mapped from store_path
+    
+    def __len__(self):
+        return len(self.timestamps)
+    
+    def __getstate__(self):
+        #a memory mapped store is sent to worker processes as just its path and mapped again there,
+        #so every process shares the same pages instead of getting its own copy of the diffs
+        if self.path is not None:
+            return { 'path' : self.path }
+        return self.__dict__
+    
+    def __setstate__(self, state):
+        if 'timestamps' not in state:
+            state = LoadDiffPixelsIntoMemory(state['path']).__dict__
+        self.__dict__.update(state)
+    
+    def __getitem__(self, pixel):
+        #returns (timestamps, colours) views of a pixel's diffs, nothing is copied
+        start, end = self.getPixelRange(pixel[0], pixel[1])
+        return self.timestamps[start:end], self.colours[start:end]
+    
+    def getPixelRange(self, x, y):
+        pixel_index = x * board_size + y
+        return int(self.offsets[pixel_index]), int(self.offsets[pixel_index + 1])
+    
+    def getSweepPosition(self, timestamp):
+        #number of diffs with a timestamp at or before the given timestamp
+        return int(numpy.searchsorted(self.sweep_timestamps, timestamp, side='right'))
+
+class KeyframeIndex:
+    #keyframes[k] is the full board, indexed [y, x], after the first positions[k] diffs in timestamp order
+    def __init__(self, keyframes, positions):
+        self.keyframes = keyframes
+        self.positions = positions
+    
+    def __len__(self):
+        return len(self.positions)
+    
+    def getNearest(self, position):
+        #index of the last keyframe at or before a sweep position
+        return int(numpy.searchsorted(self.positions, position, side='right')) - 1
+        
+class GifWriter:
+    #writes canvases of colour keys to a gif as they're rendered, so memory use doesn't grow with the number of frames.
+    #With delta_frames only the rectangle that changed since the last frame is encoded and pixels inside it that
+    #didn't change are left transparent, so the previous frame shows through. A frame the same as the one before
+    #isn't encoded at all, the one before is shown for longer. Each frame is held until the next one differs so its
+    #duration is known when it's written
+    def __init__(self, filename, width, height, duration = gif_frame_duration, delta_frames = False):
+        self.duration = duration
+        self.delta_frames = delta_frames
+        self.previous_canvas = None
+        self.pending_frame = None
+        self.pending_delay = 0
+        self.frame_count = 0
         
-        def __str__(self):
-            return "Pixel Diff[ Timestamp:" + datetime.datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M:%S') + " X:" + str(self.x) + " Y:" + str(self.y) + " Colour:" + str(self.colour)
+        #global colour table has room for 32 colours, the 16 r/place colours then the transparent index
+        colour_table = numpy.zeros((32, 3), dtype=numpy.uint8)
+        colour_table[:len(GetColorTable())] = GetPaletteArray()
         
-        def getSQLiteInsertString(self):
-            return "(" + str(self.timestamp) + "," + str(self.x) + "," + str(self.y) + "," + str(self.colour) + ")"
+        self.width = width
+        self.height = height
+        self.gif_file = open(filename, "wb")
+        self.gif_file.write(b"GIF89a" + struct.pack('<HHBBB', width, height, 0xF4, 0, 0) + colour_table.tobytes())
+        #loop forever
+        self.gif_file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack('<H', 0) + b"\x00")
+    
+    def append(self, canvas):
+        if self.previous_canvas is not None and numpy.array_equal(canvas, self.previous_canvas):
+            self.appendEncoded(None)
+            return
+        
+        self.appendEncoded(EncodeGifFrame(canvas, self.previous_canvas, self.delta_frames))
+        self.previous_canvas = canvas.copy()
+    
+    def appendEncoded(self, frame_bytes, duration = None):
+        #frames that were already encoded with EncodeGifFrame, e.g. by a worker process. None repeats the frame before
+        if duration is None:
+            duration = self.duration
+        
+        #gif delays are in hundredths of a second, each frame is rounded down on its own before it's added so a
+        #collapsed run plays exactly as long as the frames it replaces would have
+        delay = int(duration / 10)
+        
+        if frame_bytes is None and self.pending_frame is not None:
+            self.pending_delay += delay
+            metrics.count("frames.collapsed")
+            return
+        
+        self.flush()
+        self.pending_frame = frame_bytes
+        self.pending_delay = delay
+    
+    def flush(self):
+        if self.pending_frame is None:
+            return
+        
+        #graphic control extension. Delta frames leave the frame in place for the next one to draw over and treat
+        #gif_transparent_index as transparent
+        flags = 0x05 if self.delta_frames else 0x00
+        delay = min(self.pending_delay, 0xFFFF)
+        self.gif_file.write(b"!\xf9\x04" + struct.pack('<BHBB', flags, delay, gif_transparent_index if self.delta_frames else 0, 0) + self.pending_frame)
+        self.frame_count += 1
+        self.pending_frame = None
+    
+    def close(self):
+        self.flush()
+        self.gif_file.write(b";")
+        self.gif_file.close()
+
+class BatchJob:
+    #one output of a batch run, given a crop of the shared board at each of its frame timestamps
+    def __init__(self, x1, y1, x2, y2, frame_timestamps, enlarge = 1, delta_frames = False, output = None, output_format = "gif", scale = 1):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.frame_timestamps = frame_timestamps
+        self.enlarge = enlarge
+        self.scale = scale
+        self.delta_frames = delta_frames
+        self.output_format = output_format
+        self.output = output
+        self.gif = None
         
+        if self.output is None:
+            name = str(frame_timestamps[0]) + "_" + str(x1) + "_" + str(y1) + "_" + str(x2) + "_" + str(y2) + "_" + str(len(frame_timestamps))
+            self.output = name + ".gif" if output_format == "gif" else "seq_" + name
+    
+    def start(self):
+        if self.output_format == "gif":
+            self.gif = GifWriter(self.output, GetScaledLength(self.x2 - self.x1 + 1, self.scale) * self.enlarge,
+                                 GetScaledLength(self.y2 - self.y1 + 1, self.scale) * self.enlarge, gif_frame_duration, self.delta_frames)
+        elif not os.path.exists(self.output):
+            os.makedirs(self.output)
+    
+    def addFrame(self, frame_timestamp, board):
+        #crops don't line up with the board's blocks, so a scaled job shrinks its own crop
+        canvas = DownsampleCanvas(board[self.y1:self.y2 + 1, self.x1:self.x2 + 1], self.scale)
+        if self.gif is not None:
+            self.gif.append(EnlargeCanvas(canvas, self.enlarge))
+        else:
+            SaveCanvasAsPNG(canvas, os.path.join(self.output, str(frame_timestamp) + ".png"), self.enlarge)
+    
+    def close(self):
+        if self.gif is not None:
+            self.gif.close()
+
+class TimingSpan:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+    
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.addSpan(self.name, time.perf_counter() - self.start_time)
+        return False
+
+class Metrics:
+    #named timing spans, counters and peak memory for a run. Spans add up every time they're entered,
+    #so a span around a per frame step gives the total time spent in that step. Cheap enough to leave on.
+    #Updates hold a lock so threads, like the server's render threads, don't lose counts or read half an update
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.spans = {}
+            self.counters = {}
+            self.peak_rss_mb = None
+    
+    def span(self, name):
+        return TimingSpan(self, name)
+    
+    def timed(self, name):
+        #decorator that times every call of a function as a span
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with TimingSpan(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def addSpan(self, name, seconds, calls = 1):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = [0.0, 0]
+            span[0] += seconds
+            span[1] += calls
+        self.samplePeakMemory()
+    
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def samplePeakMemory(self, peak_rss_mb = None):
+        if peak_rss_mb is None:
+            peak_rss_mb = GetPeakRSS()
+        with self.lock:
+            if peak_rss_mb is not None and (self.peak_rss_mb is None or peak_rss_mb > self.peak_rss_mb):
+                self.peak_rss_mb = peak_rss_mb
+    
+    def snapshot(self):
+        self.samplePeakMemory()
+        with self.lock:
+            return { 'wall_seconds' : time.perf_counter() - self.start_time,
+                     'peak_rss_mb' : self.peak_rss_mb,
+                     'spans' : dict((name, { 'seconds' : span[0], 'calls' : span[1] }) for name, span in self.spans.items()),
+                     'counters' : dict(self.counters) }
+    
+    def merge(self, snapshot):
+        #add in a snapshot from a worker process, peak memory is the peak of any one process
+        for name, span in snapshot['spans'].items():
+            self.addSpan(name, span['seconds'], span['calls'])
+        for name, amount in snapshot['counters'].items():
+            self.count(name, amount)
+        self.samplePeakMemory(snapshot['peak_rss_mb'])
+    
+    def log(self):
+        snapshot = self.snapshot()
+        for name, span in sorted(snapshot['spans'].items()):
+            logging.info("span {0}: {1:.3f} seconds over {2} calls".format(name, span['seconds'], span['calls']))
+        for name, amount in sorted(snapshot['counters'].items()):
+            logging.info("counter {0}: {1} ({2:,.0f}/sec)".format(name, amount, amount / max(snapshot['wall_seconds'], 1e-9)))
+        if snapshot['peak_rss_mb'] is not None:
+            logging.info("peak memory: {0:.0f}MB".format(snapshot['peak_rss_mb']))
+    
+    def dump(self, path):
+        with open(path, "w") as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=4, sort_keys=True)
+
+def GetPeakRSS():
+    #peak resident memory of this process in MB, None where it can't be measured
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #linux reports KB, mac reports bytes
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+metrics = Metrics()
+
 class ProgressBarWrapper:
+    #console progress only, timings and counts go to metrics whether or not the bar is shown
     def __init__(self, label, update_interval, max_value):
-        if not silent:
+        self.silent = silent
+        if not self.silent:
+            import progressbar
             self.bar = progressbar.ProgressBar(widgets = [label, 
                                                      progressbar.Bar(marker='#', left='[', right=']')], max_value=max_value)
             self.bar_progress = 0
@@ -116,7 +512,7 @@ class ProgressBarWrapper:
             self.update_interval = update_interval;
         
     def update(self):
-        if not silent:
+        if not self.silent:
             self.bar_progress += 1
             self.bar_update_count += 1
             if self.bar_progress % self.update_interval == 0:
@@ -124,7 +520,7 @@ class ProgressBarWrapper:
                 self.bar.update(self.bar_progress)
             
     def finish(self):
-        if not silent:
+        if not self.silent:
             self.bar.update(self.bar_progress)
             self.bar.finish()
 
@@ -138,6 +534,8 @@ def DropAllTables():
     
     c.execute("drop table if exists pixel_base")
     
+    c.execute("drop table if exists ingest_progress")
+    
     conn.commit()
     
     conn.close()
@@ -145,100 +543,224 @@ def DropAllTables():
     logging.info("Finished dropping all tables")
     
 
+def GetUsableLength(path):
+    #bytes of a source file that builds use. diffs.bin can end part way through a record while it's still being
+    #downloaded or appended to, only its whole records are used and the rest is picked up by a later run
+    size = os.path.getsize(path)
+    if os.path.basename(path) == "diffs.bin":
+        size -= size % diff_record_dtype.itemsize
+    return size
+
+def ReadPixelDiffRecords(path = "diffs.bin"):
+    #memory map the whole records of the file as one record array, records are only read in when they're sliced
+    number_of_diffs = os.path.getsize(path) // diff_record_dtype.itemsize
+    if os.path.getsize(path) % diff_record_dtype.itemsize != 0:
+        logging.warn("Pixel diffs binary file: " + path + " ends part way through a record, leaving it for the next run")
+    if number_of_diffs == 0:
+        return numpy.zeros(0, dtype=diff_record_dtype)
+    
+    return numpy.memmap(path, dtype=diff_record_dtype, mode='r', shape=(number_of_diffs,))
+
+def ReadPixelDiffBatches(path, first_diff, batch_size):
+    #(batch start, records) read in with plain reads instead of through a memory map, so the parts of diffs.bin that
+    #have been dealt with don't stay resident while the rest is read
+    number_of_diffs = os.path.getsize(path) // diff_record_dtype.itemsize
+    with open(path, "rb") as diffs_file:
+        diffs_file.seek(first_diff * diff_record_dtype.itemsize)
+        batch_start = first_diff
+        while batch_start < number_of_diffs:
+            #a part written record at the end is left alone
+            batch = numpy.fromfile(diffs_file, dtype=diff_record_dtype, count=min(batch_size, number_of_diffs - batch_start))
+            if len(batch) == 0:
+                break
+            yield batch_start, batch
+            batch_start += len(batch)
+
+def PrefetchInBackground(items, max_items):
+    #runs a generator on its own thread and hands its items over through a queue holding at most max_items, so the
+    #next stage has work waiting without the generator ever getting more than max_items ahead of it
+    handover = queue.Queue(max_items)
+    finished = object()
+    stopping = threading.Event()
+    
+    def HandOver(entry):
+        #gives up if the consumer has stopped taking items, rather than waiting on a full queue forever
+        while not stopping.is_set():
+            try:
+                handover.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def Produce():
+        try:
+            for item in items:
+                if not HandOver((item, None)):
+                    return
+            HandOver((finished, None))
+        except Exception as error:
+            HandOver((finished, error))
+    
+    producer = threading.Thread(target=Produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = handover.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                break
+            yield item
+    finally:
+        #the consumer gave up early, let the producer stop instead of blocking on a full queue
+        stopping.set()
+        producer.join()
+
+def IterateRows(rows, rows_per_slice = 10000):
+    #rows of a 2d array as python lists a slice at a time, executemany takes them one by one so the whole batch is
+    #never turned into python objects at once
+    for slice_start in range(0, len(rows), rows_per_slice):
+        for row in rows[slice_start:slice_start + rows_per_slice].tolist():
+            yield row
+
+def GetIngestProgress(cursor, source):
+    #(bytes of source already in the tables, sha1 of those bytes), committed along with the rows they cover
+    cursor.execute("CREATE TABLE IF NOT EXISTS ingest_progress (source text PRIMARY KEY, offset int, sha1 text)")
+    cursor.execute("SELECT offset, sha1 FROM ingest_progress WHERE source = ?", (source,))
+    return cursor.fetchone()
+
+def SetIngestProgress(cursor, source, offset, sha1):
+    cursor.execute("INSERT OR REPLACE INTO ingest_progress VALUES (?,?,?)", (source, offset, sha1))
+
+@metrics.timed("ingest.sqlite_diffs")
 def PopulateSQLiteWithPixelDiffs():
-    all_diffs = []
     logging.info("starting to read in binary data")
     
-    
     try:
-        with open("diffs.bin", "rb") as binary_file:
-            binary_file.seek(0)
-            pixel_diff_bytes = binary_file.read(16)
-            number_of_diffs = os.path.getsize("diffs.bin") / 16
-            bar = ProgressBarWrapper("Loading pixel diffs: ", 50000, number_of_diffs)
-            
-            while pixel_diff_bytes:
-                pixel_diff_tuple = struct.unpack('<IIII', pixel_diff_bytes)
-                pixel_diff = DiffPixel(pixel_diff_tuple[0], pixel_diff_tuple[1], pixel_diff_tuple[2], pixel_diff_tuple[3])
-                all_diffs.append(pixel_diff)
-                pixel_diff_bytes = binary_file.read(16)
-                bar.update()
-    
+        records = ReadPixelDiffRecords("diffs.bin")
     except IOError:
         logging.critical("Could not open pixel diffs binary file: diffs.bin")
         exit("Could not open pixel diffs binary file: diffs.bin")
-         
-    bar.finish()
-       
-    logging.info("completed reading in binary data")
     
-    logging.info("starting to write pixel diffs to SQLite table")
-            
+    number_of_diffs = len(records)
+    
     conn = sqlite3.connect('PlaceData.db')
+    #every batch is committed with how far into diffs.bin it got, WAL keeps those commits cheap
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
     c = conn.cursor()
     
-    c.execute('''CREATE TABLE pixel_diffs (timestamp int, x int, y int, colour int)''')
+    #carry on from the last committed batch if diffs.bin still starts with what was ingested,
+    #this covers both an interrupted ingest and new diffs appended to the end of diffs.bin
+    first_diff = 0
+    sha1 = hashlib.sha1()
+    progress = GetIngestProgress(c, "diffs.bin")
+    if progress is not None:
+        offset, checksum = progress
+        if offset <= GetUsableLength("diffs.bin"):
+            sha1 = GetFileSha1("diffs.bin", offset)
+        if sha1.hexdigest() == checksum:
+            first_diff = offset // diff_record_dtype.itemsize
+        else:
+            logging.warn("diffs.bin has changed since it was ingested, starting again")
+            sha1 = hashlib.sha1()
+    
+    if first_diff == 0:
+        c.execute("DROP TABLE IF EXISTS pixel_diffs")
+        #clustered on (tile, timestamp) so a region and time window is a handful of contiguous range scans,
+        #seq is the record number in diffs.bin, it keeps diffs with the same timestamp unique and in order
+        c.execute('''CREATE TABLE pixel_diffs (tile_x int, tile_y int, timestamp int, seq int, x int, y int, colour int,
+                                               PRIMARY KEY (tile_x, tile_y, timestamp, seq)) WITHOUT ROWID''')
+        conn.commit()
+    else:
+        logging.info("already ingested " + str(first_diff) + " pixel diffs, carrying on from there")
+    
+    number_to_write = number_of_diffs - first_diff
+    logging.info("starting to write " + str(number_to_write) + " pixel diffs to SQLite table")
+    
+    start_time = time.perf_counter()
     
-    c.execute('''CREATE INDEX pixel_diffs_index ON pixel_diffs (timestamp, x, y)''')
+    del records
     
-    bar = ProgressBarWrapper("Inserting pixel diffs: ", 50000, number_of_diffs)
-    for curDiff in  all_diffs:
-        c.execute("INSERT INTO pixel_diffs VALUES " + curDiff.getSQLiteInsertString())
+    def PrepareBatches():
+        for batch_start, batch in ReadPixelDiffBatches("diffs.bin", first_diff, ingest_batch_size):
+            #insert each batch in primary key order, diffs.bin is in time order so each tile's rows go on the end of it
+            order = numpy.lexsort((batch['timestamp'], batch['y'] // tile_size, batch['x'] // tile_size))
+            ordered = batch[order]
+            rows = numpy.column_stack((ordered['x'] // tile_size, ordered['y'] // tile_size, ordered['timestamp'], order + batch_start,
+                                       ordered['x'], ordered['y'], ordered['colour'])).astype(numpy.int64)
+            yield batch_start, batch, rows
+    
+    #the next batch is read and sorted on another thread while this one is inserted
+    bar = ProgressBarWrapper("Inserting pixel diffs: ", 1, max((number_to_write + ingest_batch_size - 1) // ingest_batch_size, 1))
+    for batch_start, batch, rows in PrefetchInBackground(PrepareBatches(), ingest_queue_batches):
+        c.executemany("INSERT INTO pixel_diffs VALUES (?,?,?,?,?,?,?)", IterateRows(rows))
+        
+        sha1.update(batch.view(numpy.uint8))
+        SetIngestProgress(c, "diffs.bin", (batch_start + len(batch)) * diff_record_dtype.itemsize, sha1.hexdigest())
+        conn.commit()
+        
+        metrics.count("rows.inserted", len(rows))
         bar.update()
     
     bar.finish()
     
-    conn.commit()
-    
     conn.close()
     
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    rate = "Wrote {0} pixel diffs in {1:.1f} seconds ({2:,.0f} records/sec)".format(number_to_write, elapsed, number_to_write / elapsed)
+    logging.info(rate)
+    print(rate)
+    
     logging.info("completed writing pixel diffs to SQLite table")
     
 
-def PopulateSQLiteWithBasePixels():
-    all_base_pixels = []
+@metrics.timed("ingest.base_board")
+def BuildBaseBoard():
     try:
-        im = Image.open("base.png")
+        base_sha1 = GetFileHash("base.png")
     except IOError:
         logging.critical("Could not open pixel base png: base.png")
         exit("Could not open pixel base png: base.png")
-    width, height = im.size
-    
-    logging.info("starting to read in png file to get base pixel values")
-    
-    bar = ProgressBarWrapper("Loading base pixels: ", 500, width * height)
-    
-    for outer in range(0,width):
-        for inner in range(0, height):
-            all_base_pixels.append(BasePixel(outer,inner,ColourLookupRGBToKey(im.getpixel((outer,inner)))))
-            bar.update()
-            
-    
-    bar.finish()        
-    logging.info("completed reading in png file to get base pixel values")    
-    
-    logging.info("starting to write base pixel to SQLite table")
     
     conn = sqlite3.connect('PlaceData.db')
     c = conn.cursor()
     
-    c.execute('''CREATE TABLE pixel_base (x int, y int, colour int)''')
+    #base.png hasn't changed since it was last ingested, nothing to do
+    if GetIngestProgress(c, "base.png") == (os.path.getsize("base.png"), base_sha1) and os.path.exists(base_path):
+        logging.info("base board is already built")
+        conn.close()
+        return
     
-    c.execute('''CREATE INDEX pixel_base_index ON pixel_base (x, y)''')
+    logging.info("starting to read in png file to get base pixel values")
     
-    bar = ProgressBarWrapper("Inserting base pixels: ", 1000, len(all_base_pixels))
+    try:
+        board = ReadBaseBoard("base.png")
+    except IOError:
+        logging.critical("Could not open pixel base png: base.png")
+        exit("Could not open pixel base png: base.png")
+    except ValueError as error:
+        logging.critical("Pixel base png isn't an r/place board: " + str(error))
+        exit("Pixel base png isn't an r/place board: " + str(error))
     
-    for curPixel in  all_base_pixels:
-        c.execute("INSERT INTO pixel_base VALUES " + curPixel.getSQLiteInsertString())
-        bar.update()
+    #written to the side and swapped in so a half written board is never picked up
+    with open(base_path + ".tmp", "wb") as base_file:
+        numpy.save(base_file, board)
+    os.replace(base_path + ".tmp", base_path)
     
-    bar.finish()
+    SetIngestProgress(c, "base.png", os.path.getsize("base.png"), base_sha1)
     conn.commit()
-    
     conn.close()
     
-    logging.info("completed writing base pixel to SQLite table")
+    logging.info("completed writing base board to: " + base_path)
     
+def ValidateBaseBoard():
+    #the base pixels used to be a pixel_base table, now they're a board next to the database
+    if LoadBasePixelsIntoMemory().shape != (board_size, board_size):
+        raise ValueError("Base board is the wrong size")
+
 def ValidateSQLiteTables():
     #check if tables exist and have right number of entries, if not rebuild
     logging.info("Validating SQLite Tables")
@@ -255,32 +777,190 @@ def ValidateSQLiteTables():
         raise ValueError("pixel_diffs tables doesn't exist")
 
 
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pixel_base'")
-    
-    result = c.fetchone()
-    if result is None:
-        raise ValueError("Database doesn't exist")
-    if result[0] != "pixel_base":
-        raise ValueError("pixel_base tables doesn't exist")
+    #tables from before the tile layout have to be rebuilt
+    c.execute("PRAGMA table_info(pixel_diffs)")
+    if "tile_x" not in [column[1] for column in c.fetchall()]:
+        raise ValueError("pixel_diffs table isn't clustered by tile")
     
+    expected_diffs = 11968422
+    if os.path.exists("diffs.bin"):
+        expected_diffs = os.path.getsize("diffs.bin") // diff_record_dtype.itemsize
     
-    c.execute("SELECT MAX(_ROWID_) FROM 'pixel_base' LIMIT 1")
+    c.execute("SELECT COUNT(*) FROM pixel_diffs")
     result = c.fetchone()
     if result is None:
         raise ValueError("Database doesn't exist")
-    if result[0] != 1000000:
-        raise ValueError("Wrong row count is pixel_base")
-
-    c.execute("SELECT MAX(_ROWID_) FROM 'pixel_diffs' LIMIT 1")
-    result = c.fetchone()
-    if result is None:
-        raise ValueError("Database doesn't exist")
-    if result[0] != 11968422:
+    if result[0] != expected_diffs:
         raise ValueError("Wrong row count is pixel_diffs")
     
     conn.close()
 
 
+def GetFileSha1(path, length = None):
+    #sha1 of the first length bytes of a file, or all of it, returned unfinished so more can be added on
+    sha1 = hashlib.sha1()
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, "rb") as source_file:
+        while remaining > 0:
+            block = source_file.read(min(remaining, 16 * 1024 * 1024))
+            if not block:
+                break
+            sha1.update(block)
+            remaining -= len(block)
+    return sha1
+
+def GetFileHash(path, length = None):
+    return GetFileSha1(path, length).hexdigest()
+
+def GetSourceFingerprints(sources):
+    #size, mtime and hash of each source file a build was made from, missing files are left out
+    fingerprints = {}
+    for source in sources:
+        if os.path.exists(source):
+            stat = os.stat(source)
+            length = GetUsableLength(source)
+            fingerprints[source] = { 'size' : length, 'mtime' : stat.st_mtime, 'sha1' : GetFileHash(source, length) }
+    return fingerprints
+
+def LoadManifest():
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        return {}
+    
+    if manifest.get('format_version') != manifest_format_version:
+        return {}
+    
+    return manifest
+
+def WriteManifest(manifest):
+    #write then rename so a crash can't leave half a manifest behind
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def RecordManifestSection(section, sources, outputs, settings = None, counts = None):
+    manifest = LoadManifest()
+    manifest['format_version'] = manifest_format_version
+    sections = manifest.setdefault('sections', {})
+    sections[section] = { 'sources' : GetSourceFingerprints(sources),
+                          'outputs' : outputs,
+                          'settings' : settings or {},
+                          'counts' : counts or {},
+                          'created' : time.time() }
+    WriteManifest(manifest)
+    
+    logging.info("recorded " + section + " in " + manifest_path)
+
+def ValidateFromManifest(section, sources, settings = None):
+    #cheap check that a build is still current, sources are only hashed when their size matches but mtime has changed
+    manifest = LoadManifest()
+    entry = manifest.get('sections', {}).get(section)
+    if entry is None:
+        raise LookupError(section + " isn't in " + manifest_path)
+    
+    if entry['settings'] != (settings or {}):
+        raise ValueError(section + " was built with different settings")
+    
+    for output in entry['outputs']:
+        if not os.path.exists(output):
+            raise ValueError(section + " output " + output + " is missing")
+    
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        recorded = entry['sources'].get(source)
+        if recorded is None:
+            raise ValueError(section + " wasn't built from " + source)
+        stat = os.stat(source)
+        if GetUsableLength(source) != recorded['size']:
+            raise ValueError(source + " has changed since " + section + " was built")
+        if stat.st_mtime != recorded['mtime']:
+            if GetFileHash(source, recorded['size']) != recorded['sha1']:
+                raise ValueError(source + " has changed since " + section + " was built")
+            #only touched, remember the new mtime so it isn't hashed again next run
+            recorded['mtime'] = stat.st_mtime
+            WriteManifest(manifest)
+
+def GetUnchangedPrefix(section, source):
+    #number of bytes at the start of source that are the same as when section was built, None if source has been
+    #rewritten or shrunk since and section has to be built from scratch
+    entry = LoadManifest().get('sections', {}).get(section)
+    if entry is None or source not in entry['sources'] or not os.path.exists(source):
+        return None
+    
+    recorded = entry['sources'][source]
+    if GetUsableLength(source) < recorded['size'] or GetFileHash(source, recorded['size']) != recorded['sha1']:
+        return None
+    
+    return recorded['size']
+
+def IsTimeOrderedAppend(records, number_of_old_records):
+    #diffs appended to diffs.bin only leave the timestamp ordered sweep arrays and keyframes alone if none of them
+    #are older than the diffs that were already there
+    if number_of_old_records == 0 or number_of_old_records >= len(records):
+        return True
+    return records['timestamp'][number_of_old_records:].min() >= records['timestamp'][:number_of_old_records].max()
+
+def ResizeNpy(path, length):
+    #changes the length of the first axis of a .npy file, new space is zero filled. The header is rewritten in place
+    #after the data when it still fits, otherwise the whole file is copied
+    with open(path, "r+b") as npy_file:
+        version = numpy.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(npy_file)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(npy_file)
+        data_start = npy_file.tell()
+        
+        new_shape = (length,) + tuple(shape[1:])
+        header = io.BytesIO()
+        numpy.lib.format.write_array_header_1_0(header, { 'descr' : numpy.lib.format.dtype_to_descr(dtype),
+                                                          'fortran_order' : False,
+                                                          'shape' : new_shape })
+        
+        if version == (1, 0) and not fortran_order and len(header.getvalue()) == data_start:
+            npy_file.truncate(data_start + int(numpy.prod(new_shape)) * dtype.itemsize)
+            npy_file.seek(0)
+            npy_file.write(header.getvalue())
+            return
+    
+    old = numpy.load(path, mmap_mode='r')
+    resized = numpy.lib.format.open_memmap(path + ".tmp.npy", mode='w+', dtype=old.dtype, shape=new_shape)
+    resized[:min(length, len(old))] = old[:length]
+    resized.flush()
+    del old, resized
+    os.replace(path + ".tmp.npy", path)
+
+def AppendToNpy(path, values):
+    length = len(numpy.load(path, mmap_mode='r'))
+    ResizeNpy(path, length + len(values))
+    appended = numpy.load(path, mmap_mode='r+')
+    appended[length:] = values
+    appended.flush()
+
+def EnsureBuilt(section, sources, outputs, validate, build, settings = None, counts = None):
+    #validate against the manifest, builds from before the manifest fall back to the slow validation once
+    try:
+        ValidateFromManifest(section, sources, settings)
+        return
+    except LookupError as error:
+        logging.info(str(error) + ", validating the slow way")
+        try:
+            validate()
+            RecordManifestSection(section, sources, outputs, settings, counts() if counts else None)
+            return
+        except ValueError as error:
+            message = section + " is out of date: " + str(error)
+    except ValueError as error:
+        message = section + " is out of date: " + str(error)
+    
+    logging.warn(message)
+    print(message)
+    build()
+    RecordManifestSection(section, sources, outputs, settings, counts() if counts else None)
+
 def ValidateArgs(x1, y1, x2, y2, timestamp, delay):
     #validate timestamp and x,y inputs
     if timestamp < 0:
@@ -300,6 +980,42 @@ def ValidateArgs(x1, y1, x2, y2, timestamp, delay):
     if y2 < 1 or y2 > 1000:
         raise ValueError("Bad y2 value in generate png")
     
+def ParseByteSize(size):
+    #"256M", "1.5G", "64k" or a plain number of bytes
+    units = { 'k' : 1024, 'm' : 1024 ** 2, 'g' : 1024 ** 3 }
+    text = str(size).strip().lower()
+    if text.endswith("b"):
+        text = text[:-1]
+    try:
+        if text and text[-1] in units:
+            number_of_bytes = int(float(text[:-1]) * units[text[-1]])
+        else:
+            number_of_bytes = int(text)
+    except ValueError:
+        raise ValueError(str(size) + " isn't a size, use a number of bytes or something like 256M")
+    if number_of_bytes <= 0:
+        raise ValueError("Size has to be more than 0 bytes")
+    return number_of_bytes
+
+def SetMemoryLimit(max_bytes, processes = 1):
+    #shrinks batches, chunks and queues so each stage fits in what's left under max_bytes. Stages run one after the
+    #other so each gets all of it, except rendering where every worker process replays its own chunk
+    global working_memory, ingest_batch_size, sqlite_fetch_size, replay_chunk_size
+    
+    in_use = GetPeakRSS()
+    in_use = startup_memory_estimate if in_use is None else int(in_use * 1024 * 1024)
+    if max_bytes - in_use < min_working_memory:
+        raise ValueError("Memory limit has to leave at least " + str(min_working_memory // (1024 * 1024)) + "MB on top of the " +
+                         str(in_use // (1024 * 1024)) + "MB already in use")
+    
+    working_memory = max_bytes - in_use
+    ingest_batch_size = max(min(ingest_batch_size, working_memory // ((ingest_queue_batches + 2) * ingest_bytes_per_diff)), 1000)
+    sqlite_fetch_size = max(min(sqlite_fetch_size, working_memory // 4 // 256), 1000)
+    replay_chunk_size = max(min(replay_chunk_size, working_memory // processes // replay_bytes_per_diff), 1000)
+    
+    logging.info("memory limit " + str(max_bytes // (1024 * 1024)) + "MB, " + str(working_memory // (1024 * 1024)) + "MB to work with: " +
+                 str(ingest_batch_size) + " diffs per ingest batch, " + str(replay_chunk_size) + " diffs per replay chunk")
+
 def VerifyTableExists(table_name):
     conn = sqlite3.connect('PlaceData.db')
     c = conn.cursor()
@@ -312,98 +1028,529 @@ def VerifyTableExists(table_name):
     conn.close()
     
     
+@metrics.timed("load.base_pixels")
 def LoadBasePixelsIntoMemory():
-    VerifyTableExists("pixel_base")
+    #board of colour keys indexed [y, x], memory mapped so nothing is copied and worker processes share the pages
+    try:
+        base_pixels = numpy.load(base_path, mmap_mode='r')
+    except IOError:
+        raise ValueError("Base board: " + base_path + " does not exist, make sure you have built it")
     
-    logging.info("loading base pixels into memory")
-    #select all from pixel base table and store in dictionary
-    conn = sqlite3.connect('PlaceData.db')
-    c = conn.cursor()
+    logging.info("memory mapped base board")
     
-    print("Fetching Pixel Base...")
-    sys.stdout.flush()
-    c.execute('SELECT * FROM pixel_base')
+    return base_pixels
+
+@metrics.timed("store.build")
+def BuildPixelDiffStore():
+    logging.info("starting to build pixel diff store")
+    
+    try:
+        records = ReadPixelDiffRecords("diffs.bin")
+    except IOError:
+        logging.critical("Could not open pixel diffs binary file: diffs.bin")
+        exit("Could not open pixel diffs binary file: diffs.bin")
+    
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
     
-    base_pixels = {}
+    #keyframes built from the old diffs are stale now
+    if os.path.exists(os.path.join(store_path, "keyframe_positions.npy")):
+        os.remove(os.path.join(store_path, "keyframe_positions.npy"))
     
-    result = c.fetchall()
+    if working_memory is not None and len(records) * store_bytes_per_diff > working_memory:
+        batch_size = max(working_memory // store_batch_bytes_per_diff, 1000)
+        logging.info("store won't fit under the memory limit, building it " + str(batch_size) + " diffs at a time")
+        del records
+        BuildPixelDiffStoreInBatches("diffs.bin", batch_size)
+        return
     
-    bar = ProgressBarWrapper("Loading base pixels: ", 30000, len(result))
+    x = records['x']
+    y = records['y']
+    if len(records) and (x.max() >= board_size or y.max() >= board_size):
+        raise ValueError("Pixel diff outside of the " + str(board_size) + "x" + str(board_size) + " board in diffs.bin")
+    
+    pixel_indexes = x.astype(numpy.uint32) * board_size + y.astype(numpy.uint32)
+    
+    #lexsort is stable so diffs with the same pixel and timestamp keep their order from diffs.bin
+    order = numpy.lexsort((records['timestamp'], pixel_indexes))
+    
+    offsets = numpy.zeros(board_size * board_size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(pixel_indexes, minlength=board_size * board_size), out=offsets[1:])
+    
+    numpy.save(os.path.join(store_path, "timestamps.npy"), records['timestamp'][order].astype(numpy.uint32))
+    numpy.save(os.path.join(store_path, "colours.npy"), records['colour'][order].astype(numpy.uint8))
+    numpy.save(os.path.join(store_path, "offsets.npy"), offsets)
+    
+    #diffs.bin should already be in timestamp order, a stable sort keeps it that way if it is
+    order = numpy.argsort(records['timestamp'], kind='stable')
+    
+    numpy.save(os.path.join(store_path, "sweep_timestamps.npy"), records['timestamp'][order].astype(numpy.uint32))
+    numpy.save(os.path.join(store_path, "sweep_pixels.npy"), pixel_indexes[order])
+    numpy.save(os.path.join(store_path, "sweep_colours.npy"), records['colour'][order].astype(numpy.uint8))
+    
+    logging.info("finished building pixel diff store with " + str(len(records)) + " diffs")
+
+def ScatterInOrder(keys, cursors, outputs):
+    #stable counting sort step: the values for each key go to that key's cursor onwards in the order they come,
+    #then the cursors move past them. outputs is [(path of a .npy, values)], each is mapped only while it's written
+    order = numpy.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    run_starts = numpy.flatnonzero(numpy.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    run_lengths = numpy.diff(numpy.append(run_starts, len(sorted_keys)))
+    destinations = cursors[sorted_keys] + numpy.arange(len(sorted_keys)) - numpy.repeat(run_starts, run_lengths)
+    
+    for path, values in outputs:
+        output = numpy.load(path, mmap_mode='r+')
+        output[destinations] = values[order]
+        output.flush()
+        del output
+    
+    cursors[sorted_keys[run_starts]] += run_lengths
+
+def BuildPixelDiffStoreInBatches(path, batch_size):
+    #the same arrays as BuildPixelDiffStore without holding more than a batch of diffs. Counting how many diffs each
+    #pixel and second has gives every diff its place, then batches are scattered into place. Counting sorts are stable,
+    #so ties keep their order from diffs.bin just like the lexsort
+    def OpenOutput(name, dtype, length):
+        numpy.lib.format.open_memmap(os.path.join(store_path, name + ".npy"), mode='w+', dtype=dtype, shape=(length,))
+        return os.path.join(store_path, name + ".npy")
+    
+    #first pass for the counts, and to see whether diffs.bin is already in time order
+    pixel_counts = numpy.zeros(board_size * board_size, dtype=numpy.int64)
+    first_timestamp, last_timestamp, previous_timestamp = None, None, None
+    time_ordered = True
+    number_of_diffs = 0
+    for batch_start, batch in ReadPixelDiffBatches(path, 0, batch_size):
+        if batch['x'].max() >= board_size or batch['y'].max() >= board_size:
+            raise ValueError("Pixel diff outside of the " + str(board_size) + "x" + str(board_size) + " board in diffs.bin")
+        pixel_counts += numpy.bincount(batch['x'].astype(numpy.int64) * board_size + batch['y'], minlength=board_size * board_size)
+        timestamps = batch['timestamp']
+        time_ordered = time_ordered and (previous_timestamp is None or timestamps[0] >= previous_timestamp) and bool((timestamps[1:] >= timestamps[:-1]).all())
+        previous_timestamp = timestamps[-1]
+        first_timestamp = int(timestamps.min()) if first_timestamp is None else min(first_timestamp, int(timestamps.min()))
+        last_timestamp = int(timestamps.max()) if last_timestamp is None else max(last_timestamp, int(timestamps.max()))
+        number_of_diffs += len(batch)
+    
+    offsets = numpy.zeros(board_size * board_size + 1, dtype=numpy.int64)
+    numpy.cumsum(pixel_counts, out=offsets[1:])
+    del pixel_counts
+    
+    sweep_outputs = [OpenOutput("sweep_timestamps", numpy.uint32, number_of_diffs), OpenOutput("sweep_pixels", numpy.uint32, number_of_diffs),
+                     OpenOutput("sweep_colours", numpy.uint8, number_of_diffs)]
+    
+    #the sweep is diffs.bin as it is if it's in time order, otherwise counting sorted by second
+    second_cursors = None
+    if not time_ordered:
+        second_counts = numpy.zeros(last_timestamp - first_timestamp + 1, dtype=numpy.int64)
+        for batch_start, batch in ReadPixelDiffBatches(path, 0, batch_size):
+            second_counts += numpy.bincount(batch['timestamp'] - first_timestamp, minlength=len(second_counts))
+        second_cursors = numpy.concatenate(([0], numpy.cumsum(second_counts)[:-1]))
+        del second_counts
+    
+    bar = ProgressBarWrapper("Building pixel diff store: ", 1, max(2 * (-(-number_of_diffs // batch_size)), 1))
+    for batch_start, batch in ReadPixelDiffBatches(path, 0, batch_size):
+        values = (batch['timestamp'].astype(numpy.uint32), batch['x'].astype(numpy.uint32) * board_size + batch['y'].astype(numpy.uint32),
+                  batch['colour'].astype(numpy.uint8))
+        if second_cursors is None:
+            for output_path, batch_values in zip(sweep_outputs, values):
+                output = numpy.load(output_path, mmap_mode='r+')
+                output[batch_start:batch_start + len(batch)] = batch_values
+                output.flush()
+                del output
+        else:
+            ScatterInOrder(batch['timestamp'] - first_timestamp, second_cursors, list(zip(sweep_outputs, values)))
+        bar.update()
     
-    for row in result:
-        base_pixels[(row[0],row[1])] = row[2]
+    #then the pixel arrays are counting sorted by pixel from the sweep, which keeps each pixel's diffs in time order
+    pixel_outputs = [OpenOutput("timestamps", numpy.uint32, number_of_diffs), OpenOutput("colours", numpy.uint8, number_of_diffs)]
+    pixel_cursors = offsets[:-1].copy()
+    for batch_start in range(0, number_of_diffs, batch_size):
+        sweep = [numpy.array(numpy.load(output_path, mmap_mode='r')[batch_start:batch_start + batch_size]) for output_path in sweep_outputs]
+        ScatterInOrder(sweep[1], pixel_cursors, [(pixel_outputs[0], sweep[0]), (pixel_outputs[1], sweep[2])])
         bar.update()
     
+    numpy.save(os.path.join(store_path, "offsets.npy"), offsets)
     bar.finish()
-    conn.close()
     
-    logging.info("finished loading base pixels into memory")
+    logging.info("finished building pixel diff store with " + str(number_of_diffs) + " diffs")
+
+@metrics.timed("store.update")
+def UpdatePixelDiffStore():
+    #adds the diffs appended to diffs.bin since the store was built, anything else means building it again
+    try:
+        records = ReadPixelDiffRecords("diffs.bin")
+    except IOError:
+        logging.critical("Could not open pixel diffs binary file: diffs.bin")
+        exit("Could not open pixel diffs binary file: diffs.bin")
     
-    return base_pixels
+    prefix = GetUnchangedPrefix("store", "diffs.bin")
+    if prefix is None:
+        BuildPixelDiffStore()
+        return
+    
+    number_of_old_diffs = prefix // diff_record_dtype.itemsize
+    try:
+        ValidatePixelDiffStore(number_of_old_diffs)
+        if not IsTimeOrderedAppend(records, number_of_old_diffs):
+            raise ValueError("diffs appended to diffs.bin are older than the ones already in the store")
+    except ValueError as error:
+        logging.warn("Can't add to the pixel diff store, building it again: " + str(error))
+        BuildPixelDiffStore()
+        return
+    
+    new_records = numpy.asarray(records[number_of_old_diffs:])
+    if len(new_records) == 0:
+        return
+    
+    logging.info("adding " + str(len(new_records)) + " diffs to the pixel diff store")
+    
+    x = new_records['x']
+    y = new_records['y']
+    if x.max() >= board_size or y.max() >= board_size:
+        raise ValueError("Pixel diff outside of the " + str(board_size) + "x" + str(board_size) + " board in diffs.bin")
+    
+    pixel_indexes = x.astype(numpy.uint32) * board_size + y.astype(numpy.uint32)
+    order = numpy.lexsort((new_records['timestamp'], pixel_indexes))
+    
+    store = LoadDiffPixelsIntoMemory()
+    offsets = store.offsets + numpy.concatenate(([0], numpy.cumsum(numpy.bincount(pixel_indexes, minlength=board_size * board_size))))
+    
+    #each pixel's new diffs go after its old ones, the i'th new diff in pixel order lands at the old end of its pixel's run plus i,
+    #the old diffs keep their order and fill in the gaps
+    is_new = numpy.zeros(len(store) + len(new_records), dtype=bool)
+    is_new[store.offsets[pixel_indexes[order].astype(numpy.int64) + 1] + numpy.arange(len(new_records))] = True
+    
+    for name, old_values, new_values in (("timestamps", store.timestamps, new_records['timestamp'][order].astype(numpy.uint32)),
+                                         ("colours", store.colours, new_records['colour'][order].astype(numpy.uint8))):
+        merged = numpy.lib.format.open_memmap(os.path.join(store_path, name + ".tmp.npy"), mode='w+', dtype=old_values.dtype, shape=is_new.shape)
+        
+        #a replay chunk at a time so the old array is never read in all at once
+        new_position, old_position = 0, 0
+        for chunk_start in range(0, len(is_new), replay_chunk_size):
+            chunk_is_new = is_new[chunk_start:chunk_start + replay_chunk_size]
+            number_new = int(chunk_is_new.sum())
+            chunk = numpy.empty(len(chunk_is_new), dtype=old_values.dtype)
+            chunk[chunk_is_new] = new_values[new_position:new_position + number_new]
+            chunk[~chunk_is_new] = old_values[old_position:old_position + len(chunk) - number_new]
+            merged[chunk_start:chunk_start + len(chunk)] = chunk
+            new_position += number_new
+            old_position += len(chunk) - number_new
+        merged.flush()
+        del merged
+    numpy.save(os.path.join(store_path, "offsets.tmp.npy"), offsets)
+    
+    del store
+    
+    #the sweep arrays just get longer, then the merged pixel arrays are swapped in. Anything half done
+    #leaves the array lengths disagreeing, which fails validation and rebuilds the store
+    order = numpy.argsort(new_records['timestamp'], kind='stable')
+    AppendToNpy(os.path.join(store_path, "sweep_timestamps.npy"), new_records['timestamp'][order].astype(numpy.uint32))
+    AppendToNpy(os.path.join(store_path, "sweep_pixels.npy"), pixel_indexes[order])
+    AppendToNpy(os.path.join(store_path, "sweep_colours.npy"), new_records['colour'][order].astype(numpy.uint8))
+    
+    for name in ("timestamps", "colours", "offsets"):
+        os.replace(os.path.join(store_path, name + ".tmp.npy"), os.path.join(store_path, name + ".npy"))
+    
+    logging.info("finished adding diffs to the pixel diff store, it has " + str(len(is_new)) + " diffs")
 
-def LoadDiffPixelsIntoMemory():
+def ValidatePixelDiffStore(expected_diffs = None):
+    logging.info("Validating pixel diff store")
+    
+    store = LoadDiffPixelsIntoMemory()
+    
+    if len(store.offsets) != board_size * board_size + 1:
+        raise ValueError("Wrong number of pixel offsets in pixel diff store")
+    if len(store.colours) != len(store) or store.offsets[-1] != len(store):
+        raise ValueError("Pixel diff store arrays don't match")
+    if len(store.sweep_timestamps) != len(store) or len(store.sweep_pixels) != len(store) or len(store.sweep_colours) != len(store):
+        raise ValueError("Pixel diff store sweep arrays don't match")
+    if expected_diffs is not None and len(store) != expected_diffs:
+        raise ValueError("Pixel diff store doesn't have " + str(expected_diffs) + " diffs")
+    if expected_diffs is None and os.path.exists("diffs.bin") and len(store) * diff_record_dtype.itemsize != GetUsableLength("diffs.bin"):
+        raise ValueError("Pixel diff store is out of date with diffs.bin")
+
+@metrics.timed("load.store")
+def LoadDiffPixelsIntoMemory(path = store_path):
+    logging.info("memory mapping pixel diff store")
+    
+    try:
+        timestamps = numpy.load(os.path.join(path, "timestamps.npy"), mmap_mode='r')
+        colours = numpy.load(os.path.join(path, "colours.npy"), mmap_mode='r')
+        offsets = numpy.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        sweep_timestamps = numpy.load(os.path.join(path, "sweep_timestamps.npy"), mmap_mode='r')
+        sweep_pixels = numpy.load(os.path.join(path, "sweep_pixels.npy"), mmap_mode='r')
+        sweep_colours = numpy.load(os.path.join(path, "sweep_colours.npy"), mmap_mode='r')
+    except IOError:
+        raise ValueError("Pixel diff store: " + path + " does not exist, make sure you have built it")
+    
+    logging.info("finished memory mapping pixel diff store")
+    
+    keyframes = None
+    try:
+        keyframes = LoadKeyframeIndex(path)
+    except ValueError:
+        logging.info("no keyframe index, seeking will replay from the base pixels")
+    
+    pixels_diffs = PixelDiffStore(timestamps, colours, offsets, sweep_timestamps, sweep_pixels, sweep_colours, keyframes)
+    pixels_diffs.path = path
+    
+    return pixels_diffs
+
+@metrics.timed("load.region")
+def LoadRegionFromSQLite(x1, y1, x2, y2, start_timestamp = min_timestamp, end_timestamp = max_timestamp):
+    #load only the diffs for a region and time window, returns (base_pixels, pixels_diffs) in the same form as
+    #LoadBasePixelsIntoMemory and LoadDiffPixelsIntoMemory, the diffs are only valid for pixels inside the region
     VerifyTableExists("pixel_diffs")
+    base_pixels = LoadBasePixelsIntoMemory()
+    
+    logging.info("loading region (" + str(x1) + ", " + str(y1) + ") to (" + str(x2) + ", " + str(y2) + ") from SQLite")
     
-    logging.info("loading pixel diffs into memory")
-    #select all from pixel diffs table and store in dictionary
     conn = sqlite3.connect('PlaceData.db')
     c = conn.cursor()
+    c.arraysize = sqlite_fetch_size
+    
+    #one clustered range scan per tile, rows before the window are still needed for the state at the start of it
+    chunks = []
+    for tile_x in range(x1 // tile_size, x2 // tile_size + 1):
+        for tile_y in range(y1 // tile_size, y2 // tile_size + 1):
+            c.execute('SELECT seq, timestamp, x, y, colour FROM pixel_diffs WHERE tile_x = ? AND tile_y = ? AND timestamp <= ?',
+                      (tile_x, tile_y, end_timestamp))
+            for rows in iter(c.fetchmany, []):
+                metrics.count("rows.fetched", len(rows))
+                chunk = numpy.array(rows, dtype=numpy.int64).reshape(-1, 5)
+                chunk = chunk[(chunk[:, 2] >= x1) & (chunk[:, 2] <= x2) & (chunk[:, 3] >= y1) & (chunk[:, 3] <= y2)]
+                #kept as 13 byte records instead of 5 int64s so big regions take less memory while the rest is fetched
+                region_diffs = numpy.empty(len(chunk), dtype=region_diff_dtype)
+                region_diffs['seq'] = chunk[:, 0]
+                region_diffs['timestamp'] = chunk[:, 1]
+                region_diffs['pixel'] = chunk[:, 2] * board_size + chunk[:, 3]
+                region_diffs['colour'] = chunk[:, 4]
+                chunks.append(region_diffs)
+    
+    conn.close()
     
-    print("Fetching Pixel diffs...")
-    sys.stdout.flush()
-    c.execute('SELECT * FROM pixel_diffs')
+    diffs = numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=region_diff_dtype)
+    del chunks
+    seq, timestamps, pixel_indexes, colours = diffs['seq'], diffs['timestamp'], diffs['pixel'], diffs['colour']
     
-    pixel_diffs = defaultdict(list)
+    #sorted like the store, by pixel then timestamp with ties in diffs.bin order, so it doesn't matter whether
+    #diffs.bin is in time order. Before the window only the last diff of each pixel matters
+    order = numpy.lexsort((seq, timestamps, pixel_indexes))
+    sorted_pixels = pixel_indexes[order]
+    before_window = timestamps[order] < start_timestamp
+    superseded = numpy.zeros(len(order), dtype=bool)
+    superseded[:-1] = before_window[1:] & (sorted_pixels[:-1] == sorted_pixels[1:])
+    order = order[~superseded]
     
-    result = c.fetchall()
-    bar = ProgressBarWrapper("Loading pixel diffs: ", 50000, len(result))
-    for row in result:
-        pixel_diffs[(row[1],row[2])].append((row[0],row[3]))
+    offsets = numpy.zeros(board_size * board_size + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(pixel_indexes[order], minlength=board_size * board_size), out=offsets[1:])
+    
+    sweep_order = order[numpy.lexsort((seq[order], timestamps[order]))]
+    
+    logging.info("finished loading region with " + str(len(order)) + " diffs")
+    
+    pixels_diffs = PixelDiffStore(timestamps[order].astype(numpy.uint32), colours[order].astype(numpy.uint8), offsets,
+                                  timestamps[sweep_order].astype(numpy.uint32), pixel_indexes[sweep_order].astype(numpy.uint32),
+                                  colours[sweep_order].astype(numpy.uint8))
+    
+    return base_pixels, pixels_diffs
+
+def GetKeyframePositions(pixels_diffs, diff_interval, seconds_interval = None):
+    if seconds_interval is not None:
+        if seconds_interval <= 0:
+            raise ValueError("Keyframe interval has to be a positive number of seconds")
+        keyframe_timestamps = numpy.arange(min_timestamp, max_timestamp + seconds_interval, seconds_interval)
+        positions = numpy.searchsorted(pixels_diffs.sweep_timestamps, keyframe_timestamps, side='right')
+    else:
+        if diff_interval <= 0:
+            raise ValueError("Keyframe interval has to be a positive number of diffs")
+        positions = numpy.arange(0, len(pixels_diffs) + 1, diff_interval)
+    
+    #the first keyframe is always the base pixels and the last one the final board
+    return numpy.unique(numpy.concatenate(([0], positions, [len(pixels_diffs)]))).astype(numpy.int64)
+
+@metrics.timed("keyframes.build")
+def BuildKeyframeIndex(base_pixels, pixels_diffs, diff_interval = keyframe_diff_interval, seconds_interval = keyframe_seconds_interval):
+    positions = GetKeyframePositions(pixels_diffs, diff_interval, seconds_interval)
+    
+    logging.info("starting to build " + str(len(positions)) + " keyframes, using " + str(len(positions) * board_size * board_size // (1024 * 1024)) + "MB of disk")
+    
+    keyframes = numpy.lib.format.open_memmap(os.path.join(store_path, "keyframes.npy"), mode='w+', dtype=numpy.uint8,
+                                             shape=(len(positions), board_size, board_size))
+    canvas = GetBaseCanvas(0, 0, board_size - 1, board_size - 1, base_pixels)
+    
+    bar = ProgressBarWrapper("Building keyframes: ", 1, len(positions))
+    previous_position = 0
+    for index, position in enumerate(positions):
+        ApplyDiffsToCanvas(canvas, 0, 0, pixels_diffs.sweep_pixels[previous_position:position], pixels_diffs.sweep_colours[previous_position:position])
+        keyframes[index] = canvas
+        previous_position = position
         bar.update()
+    
+    bar.finish()
+    keyframes.flush()
+    del keyframes
+    
+    #positions are written last so a half built index fails validation
+    numpy.save(os.path.join(store_path, "keyframe_positions.npy"), positions)
+    
+    logging.info("finished building keyframes")
+
+@metrics.timed("keyframes.update")
+def UpdateKeyframeIndex(pixels_diffs, diff_interval = keyframe_diff_interval, seconds_interval = keyframe_seconds_interval):
+    #keyframes from before the diffs appended to diffs.bin are still right, only the ones after them get built
+    entry = LoadManifest().get('sections', {}).get("keyframes")
+    prefix = GetUnchangedPrefix("keyframes", "diffs.bin")
+    
+    #the store keeps its own mapping of the old index, it's about to be resized under it
+    pixels_diffs.keyframes = None
+    
+    try:
+        if entry is None or prefix is None:
+            raise ValueError("no record of what the keyframe index was built from")
+        if entry['settings'] != { 'diff_interval' : diff_interval, 'seconds_interval' : seconds_interval }:
+            raise ValueError("keyframe interval has changed")
+        if not os.path.exists("base.png") or GetUnchangedPrefix("keyframes", "base.png") != os.path.getsize("base.png"):
+            raise ValueError("base.png has changed")
+        if not IsTimeOrderedAppend(ReadPixelDiffRecords("diffs.bin"), prefix // diff_record_dtype.itemsize):
+            raise ValueError("diffs appended to diffs.bin are older than the ones already in the keyframes")
         
+        old_keyframes = LoadKeyframeIndex()
+    except (ValueError, IOError) as error:
+        logging.warn("Can't add to the keyframe index, building it again: " + str(error))
+        BuildKeyframeIndex(LoadBasePixelsIntoMemory(), pixels_diffs, diff_interval, seconds_interval)
+        return
+    
+    positions = GetKeyframePositions(pixels_diffs, diff_interval, seconds_interval)
+    
+    #keyframes are kept up to the first one that's at a different position or after the old diffs
+    limit = min(len(positions), len(old_keyframes), len(old_keyframes.keyframes))
+    reusable = (positions[:limit] == old_keyframes.positions[:limit]) & (positions[:limit] <= prefix // diff_record_dtype.itemsize)
+    kept = limit if reusable.all() else int(numpy.argmin(reusable))
+    if kept == 0:
+        del old_keyframes
+        BuildKeyframeIndex(LoadBasePixelsIntoMemory(), pixels_diffs, diff_interval, seconds_interval)
+        return
+    
+    canvas = numpy.array(old_keyframes.keyframes[kept - 1])
+    del old_keyframes
+    
+    logging.info("keeping " + str(kept) + " keyframes, building " + str(len(positions) - kept))
+    
+    ResizeNpy(os.path.join(store_path, "keyframes.npy"), len(positions))
+    keyframes = numpy.load(os.path.join(store_path, "keyframes.npy"), mmap_mode='r+')
+    
+    bar = ProgressBarWrapper("Building keyframes: ", 1, max(len(positions) - kept, 1))
+    previous_position = positions[kept - 1]
+    for index in range(kept, len(positions)):
+        position = positions[index]
+        ApplyDiffsToCanvas(canvas, 0, 0, pixels_diffs.sweep_pixels[previous_position:position], pixels_diffs.sweep_colours[previous_position:position])
+        keyframes[index] = canvas
+        previous_position = position
+        bar.update()
+    
     bar.finish()
-    logging.info("finished loading pixel diffs into memory")
+    keyframes.flush()
+    del keyframes
+    
+    numpy.save(os.path.join(store_path, "keyframe_positions.npy"), positions)
+    
+    logging.info("finished adding keyframes")
+
+def ValidateKeyframeIndex(pixels_diffs, diff_interval = keyframe_diff_interval, seconds_interval = keyframe_seconds_interval):
+    logging.info("Validating keyframe index")
+    
+    keyframes = LoadKeyframeIndex()
+    
+    if keyframes.keyframes.shape != (len(keyframes), board_size, board_size):
+        raise ValueError("Keyframe index doesn't match its positions")
+    if not numpy.array_equal(keyframes.positions, GetKeyframePositions(pixels_diffs, diff_interval, seconds_interval)):
+        raise ValueError("Keyframe index is out of date with the pixel diff store or keyframe interval")
+
+def LoadKeyframeIndex(path = store_path):
+    try:
+        positions = numpy.load(os.path.join(path, "keyframe_positions.npy"))
+        keyframes = numpy.load(os.path.join(path, "keyframes.npy"), mmap_mode='r')
+    except IOError:
+        raise ValueError("Keyframe index in: " + path + " does not exist, make sure you have built it")
     
-    return pixel_diffs
+    return KeyframeIndex(keyframes, positions)
     
         
 def GetPixelColour(pixel_timestamp, x, y, base_pixels, pixels_diffs):
     #look up the base pixel colour
-    base_colour = base_pixels[(x,y)]
+    base_colour = int(base_pixels[y, x])
     
     #if timestamp is before data starts, return base pixel
     if pixel_timestamp < min_timestamp:
         return base_colour
     
+    timestamps, colours = pixels_diffs[x, y]
     
-    diffs = pixels_diffs[x, y]
-    
-    #if there's no diffs for that pixel return base pixel
-    if not diffs:
+    #binary search for the last diff at or before the timestamp, if there isn't one it's still the base pixel
+    position = int(numpy.searchsorted(timestamps, pixel_timestamp, side='right'))
+    if position == 0:
         return base_colour
     
-    #if timestamp is less that first diff return base value
-    if pixel_timestamp < diffs[0][0]:
-        return base_colour
+    return int(colours[position - 1])
+
+def SearchPixelDiffs(timestamps, pixel_indexes, pixels_diffs):
+    #batched binary search, returns the store index of the last diff at or before each timestamp
+    #within that pixel's run of diffs, or -1 where the pixel hasn't changed yet
+    offsets = pixels_diffs.offsets
+    diff_timestamps = pixels_diffs.timestamps
+    start = numpy.asarray(offsets[pixel_indexes], dtype=numpy.int64)
+    low = start.copy()
+    high = numpy.asarray(offsets[pixel_indexes + 1], dtype=numpy.int64)
+    
+    #every query narrows its own [low, high) range in lockstep, so this loops log2(longest run) times
+    searching = low < high
+    while searching.any():
+        middle = (low + high) // 2
+        at_or_before = numpy.zeros(len(middle), dtype=bool)
+        at_or_before[searching] = diff_timestamps[middle[searching]] <= timestamps[searching]
+        low = numpy.where(searching & at_or_before, middle + 1, low)
+        high = numpy.where(searching & ~at_or_before, middle, high)
+        searching = low < high
+    
+    return numpy.where(low > start, low - 1, -1)
+
+@metrics.timed("lookup.batched")
+def GetPixelColours(timestamps, xs, ys, base_pixels, pixels_diffs):
+    #vectorized GetPixelColour, takes arrays of timestamps and coordinates and returns an array of colour keys
+    timestamps, xs, ys = numpy.broadcast_arrays(numpy.asarray(timestamps, dtype=numpy.int64),
+                                                numpy.asarray(xs, dtype=numpy.int64),
+                                                numpy.asarray(ys, dtype=numpy.int64))
+    timestamps = timestamps.ravel()
+    xs = xs.ravel()
+    ys = ys.ravel()
     
-    #look through diffs to get closest diff
-    for previous_diff, current_diff in zip(diffs, diffs[1:]):
-        if pixel_timestamp == current_diff[0]:
-            return current_diff[1]
-        elif  pixel_timestamp < current_diff[0]:
-            return previous_diff[1]
-        
-    #if there's no diff that matches return last pixel value in diffs
-    return diffs[-1][1]
+    if ((xs < 0) | (xs >= board_size) | (ys < 0) | (ys >= board_size)).any():
+        raise ValueError("Pixel coordinates outside of the " + str(board_size) + "x" + str(board_size) + " board")
+    
+    metrics.count("pixels.looked_up", len(xs))
+    
+    colours = numpy.asarray(base_pixels)[ys, xs]
+    
+    diff_indexes = SearchPixelDiffs(timestamps, xs * board_size + ys, pixels_diffs)
+    changed = diff_indexes >= 0
+    colours[changed] = pixels_diffs.colours[diff_indexes[changed]]
+    
+    return colours
+
+def GetRegionColours(timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs):
+    #palette indexed canvas of the region at a timestamp, looked up pixel by pixel with GetPixelColours
+    ys, xs = numpy.mgrid[y1:y2 + 1, x1:x2 + 1]
+    return GetPixelColours(timestamp, xs, ys, base_pixels, pixels_diffs).reshape(xs.shape)
         
-def GeneratePNG(png_timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs, output_path = None, filename = None):
+def GeneratePNG(png_timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs, output_path = None, filename = None, enlarge = 1, scale = 1):
 
     #set file output path and name
     if filename is None:
         filename = "place_" + str(png_timestamp) + "_" + str(x1) + "_" + str(y1) + "_" + str(x2) + "_" + str(y2) + ".png"
     
     if output_path is None:
-        outdir = os.path.abspath(__file__)
+        outdir = os.path.dirname(os.path.abspath(__file__))
     else:
         outdir = output_path
     
@@ -414,77 +1561,395 @@ def GeneratePNG(png_timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs, output
     
     logging.info("Beginning to generate image: " + outfile)
     
-    if args.enlarge:
-        logging.info("Generating enlarged size")
-        width = x2 - x1 + 1
-        height = y2 - y1 + 1
-        im_enlarged = Image.new( 'RGB', (width * 4, height * 4), "black")
-        pixels = im_enlarged.load()
-        for i in range(width):
-            for j in range(height):
-                colour_key = GetPixelColour(png_timestamp, x1 + i, y1 + j, base_pixels, pixels_diffs)
-                enlarge_factor = 4
-                for enlarged_pixel_x in range(enlarge_factor):
-                    for enlarged_pixel_y in range(enlarge_factor):
-                        x = (i * enlarge_factor) + enlarged_pixel_x
-                        y = (j * enlarge_factor) + enlarged_pixel_y
-                        pixels[x,y] = ColourLookupKeyToRGB(colour_key)
-                        
-        im_enlarged.save(outfile, "PNG")
-        
-    else:
-        logging.info("Generating normal size")
-        #create output image and lookup pixel colour values
-        im = Image.new( 'RGB', (x2 - x1 + 1, y2 - y1 + 1), "black")
-        pixels = im.load() 
-        for i in range(im.size[0]):   
-            for j in range(im.size[1]):
-                colour_key = GetPixelColour(png_timestamp, x1 + i, y1 + j, base_pixels, pixels_diffs)
-                pixels[i,j] = ColourLookupKeyToRGB(colour_key)
-                        
-                
-                
-        im.save(outfile, "PNG")
+    #seek to the nearest keyframe and replay the diffs after it
+    canvas = GetCanvasAt(png_timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs)
+    SaveCanvasAsPNG(DownsampleCanvas(canvas, scale), outfile, enlarge)
             
     logging.info("Completed generating output image: " + filename)
     
-def GeneratePNGSequence(sequence_timestamp, length_sequence, length_step, x1, y1, x2, y2, base_pixels, pixels_diffs, out_path = None):
+@metrics.timed("render.base_canvas")
+def GetBaseCanvas(x1, y1, x2, y2, base_pixels):
+    #palette indexed canvas for the region, indexed [y, x] like an image
+    return numpy.array(base_pixels[y1:y2 + 1, x1:x2 + 1], dtype=numpy.uint8)
+
+@metrics.timed("render.apply_diffs")
+def ApplyDiffsToCanvas(canvas, x1, y1, pixel_indexes, colours, downsampled = None):
+    #paint a timestamp ordered run of diffs onto a canvas whose top left is (x1, y1), keeping a DownsampledCanvas of it up to date
+    height, width = canvas.shape
+    for chunk_start in range(0, len(pixel_indexes), replay_chunk_size):
+        chunk_pixels = numpy.asarray(pixel_indexes[chunk_start:chunk_start + replay_chunk_size], dtype=numpy.int64)
+        chunk_colours = numpy.asarray(colours[chunk_start:chunk_start + replay_chunk_size])
+        
+        local_x = chunk_pixels // board_size - x1
+        local_y = chunk_pixels % board_size - y1
+        in_region = (local_x >= 0) & (local_x < width) & (local_y >= 0) & (local_y < height)
+        canvas_indexes = local_y[in_region] * width + local_x[in_region]
+        chunk_colours = chunk_colours[in_region]
+        
+        #when a pixel is set more than once the last diff wins, numpy doesn't promise that for repeated indexes
+        _, reversed_first = numpy.unique(canvas_indexes[::-1], return_index=True)
+        last = len(canvas_indexes) - 1 - reversed_first
+        changed_indexes = canvas_indexes[last]
+        if downsampled is not None:
+            old_colours = canvas.flat[changed_indexes]
+        canvas.flat[changed_indexes] = chunk_colours[last]
+        if downsampled is not None:
+            downsampled.update(canvas, changed_indexes, old_colours)
+        
+        metrics.count("diffs.scanned", len(chunk_pixels))
+        metrics.count("diffs.applied", len(canvas_indexes))
+
+def AdvanceCanvas(canvas, position, end, x1, y1, x2, y2, pixels_diffs, downsampled = None):
+    #move a canvas forward from one sweep position to a later one, jumping to the nearest keyframe if that's closer
+    keyframes = pixels_diffs.keyframes
+    if keyframes is not None:
+        keyframe = keyframes.getNearest(end)
+        if keyframes.positions[keyframe] > position:
+            canvas[:] = keyframes.keyframes[keyframe, y1:y2 + 1, x1:x2 + 1]
+            position = int(keyframes.positions[keyframe])
+            if downsampled is not None:
+                downsampled.reset(canvas)
+    
+    if end > position:
+        ApplyDiffsToCanvas(canvas, x1, y1, pixels_diffs.sweep_pixels[position:end], pixels_diffs.sweep_colours[position:end], downsampled)
+    
+    return end
+
+@metrics.timed("render.seek")
+def GetCanvasAt(timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs):
+    position = pixels_diffs.getSweepPosition(timestamp)
+    
+    replay_start = 0
+    if pixels_diffs.keyframes is not None:
+        replay_start = int(pixels_diffs.keyframes.positions[pixels_diffs.keyframes.getNearest(position)])
+    
+    #small crops are cheaper to look up pixel by pixel than to replay every diff since the nearest keyframe
+    if (x2 - x1 + 1) * (y2 - y1 + 1) < position - replay_start:
+        return GetRegionColours(timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs)
+    
+    canvas = GetBaseCanvas(x1, y1, x2, y2, base_pixels)
+    AdvanceCanvas(canvas, 0, position, x1, y1, x2, y2, pixels_diffs)
+    
+    return canvas
+
+def ReplayFrames(frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, scale = 1, canvas = None, position = None):
+    #yields (timestamp, canvas) for ascending frame timestamps, only applying the diffs between
+    #consecutive frames. The canvas is updated in place so copy it if it has to outlive the next frame.
+    #With a scale of 2, 4 or 8 the canvas yielded is that pyramid level of the region.
+    #A full size canvas already at a sweep position before the first frame is carried on from instead of seeking
+    downsampled = None
+    if canvas is not None and scale > 1:
+        downsampled = DownsampledCanvas(canvas, scale)
+    
+    for frame_timestamp in frame_timestamps:
+        end = pixels_diffs.getSweepPosition(frame_timestamp)
+        if canvas is None:
+            canvas = GetCanvasAt(frame_timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs)
+            position = end
+            if scale > 1:
+                downsampled = DownsampledCanvas(canvas, scale)
+        else:
+            position = AdvanceCanvas(canvas, position, end, x1, y1, x2, y2, pixels_diffs, downsampled)
+        metrics.count("frames.rendered")
+        yield frame_timestamp, canvas if downsampled is None else downsampled.canvas
+
+@metrics.timed("encode.gif_frame")
+def EncodeGifFrame(canvas, previous_canvas = None, delta_frames = False):
+    #encoded gif image block for a canvas, with delta_frames only the part that changed since previous_canvas.
+    #GifWriter writes the frame's timing and transparency in front of it once it knows how long it's shown for
+    from PIL import Image, GifImagePlugin
+    
+    left, top = 0, 0
+    frame = canvas
+    
+    if delta_frames and previous_canvas is not None:
+        changed = canvas != previous_canvas
+        changed_rows = numpy.flatnonzero(changed.any(axis=1))
+        changed_columns = numpy.flatnonzero(changed.any(axis=0))
+        
+        if len(changed_rows) == 0:
+            #nothing changed, a single transparent pixel keeps the frame timing
+            frame = numpy.full((1, 1), gif_transparent_index, dtype=numpy.uint8)
+        else:
+            top, bottom = changed_rows[0], changed_rows[-1] + 1
+            left, right = changed_columns[0], changed_columns[-1] + 1
+            frame = numpy.where(changed[top:bottom, left:right], canvas[top:bottom, left:right], gif_transparent_index)
+    
+    im = Image.fromarray(numpy.ascontiguousarray(frame, dtype=numpy.uint8))
+    #getdata collects into a list on a class it defines each call, which only goes away when the garbage collector
+    #gets round to it, so empty the list to free the encoded frame straight away
+    frame_data = GifImagePlugin.getdata(im, (int(left), int(top)))
+    frame_bytes = b"".join(frame_data)
+    del frame_data[:]
+    
+    metrics.count("frames.gif")
+    metrics.count("bytes.gif", len(frame_bytes))
+    
+    return frame_bytes
+
+@metrics.timed("encode.png")
+def SaveCanvasAsPNG(canvas, outfile, enlarge = 1):
+    GetPaletteImage(canvas, enlarge).save(outfile, "PNG")
+    metrics.count("frames.png")
+
+#set in each worker process by InitRenderWorker
+worker_base_pixels = None
+worker_pixels_diffs = None
+
+def InitRenderWorker(base_pixels, pixels_diffs, chunk_size = replay_chunk_size):
+    global worker_base_pixels, worker_pixels_diffs, replay_chunk_size
+    worker_base_pixels = base_pixels
+    worker_pixels_diffs = pixels_diffs
+    replay_chunk_size = chunk_size
+
+def RenderPNGChunk(chunk):
+    #worker process: replay one contiguous run of frames into the worker's own canvas and save them as PNGs
+    frame_timestamps, previous_timestamp, x1, y1, x2, y2, enlarge, scale, out_path = chunk
+    metrics.reset()
+    for frame_timestamp, canvas in ReplayFrames(frame_timestamps, x1, y1, x2, y2, worker_base_pixels, worker_pixels_diffs, scale):
+        SaveCanvasAsPNG(canvas, os.path.join(out_path, str(frame_timestamp) + ".png"), enlarge)
+    
+    return len(frame_timestamps), metrics.snapshot()
+
+def RenderGifChunk(chunk):
+    #worker process: replay one contiguous run of frames and return them encoded as gif image blocks, in order
+    frame_timestamps, previous_timestamp, x1, y1, x2, y2, enlarge, scale, delta_frames = chunk
+    metrics.reset()
+    
+    #the first frame in the chunk is compared against the last frame of the chunk before it, for delta frames and
+    #so a repeat of it across the chunk boundary still gets collapsed. The replay carries on from that board
+    #so it's only seeked to once
+    start_canvas, start_position, previous_canvas = None, None, None
+    if previous_timestamp is not None:
+        start_canvas = GetCanvasAt(previous_timestamp, x1, y1, x2, y2, worker_base_pixels, worker_pixels_diffs)
+        start_position = worker_pixels_diffs.getSweepPosition(previous_timestamp)
+        previous_canvas = EnlargeCanvas(DownsampleCanvas(start_canvas, scale), enlarge).copy()
+    
+    #None for a frame that's the same as the one before, GifWriter shows the one before for longer
+    encoded_frames = []
+    for frame_timestamp, canvas in ReplayFrames(frame_timestamps, x1, y1, x2, y2, worker_base_pixels, worker_pixels_diffs, scale,
+                                                start_canvas, start_position):
+        frame = EnlargeCanvas(canvas, enlarge)
+        if previous_canvas is not None and numpy.array_equal(frame, previous_canvas):
+            encoded_frames.append(None)
+            continue
+        encoded_frames.append(EncodeGifFrame(frame, previous_canvas, delta_frames))
+        previous_canvas = frame.copy()
+    
+    return encoded_frames, metrics.snapshot()
+
+def RenderChunksInParallel(render_chunk, frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, workers, chunk_options, frame_bytes = 0):
+    #split the frame timeline into contiguous chunks, each worker seeks to the start of a chunk and replays it,
+    #results come back in timeline order. Workers get a copy of the 1MB base board and map the diff store
+    #themselves, so the diffs aren't copied per worker. Worker metrics are added into this process's metrics.
+    #frame_bytes is about how big a chunk's result is per frame, under --max-memory chunks are kept small enough
+    #that the ones waiting to be written out fit in half the working memory
+    number_of_chunks = min(len(frame_timestamps), workers * worker_chunks_per_worker)
+    chunk_length = -(-len(frame_timestamps) // max(number_of_chunks, 1))
+    max_waiting = workers * render_queue_chunks_per_worker
+    if working_memory is not None and frame_bytes > 0:
+        chunk_length = max(min(chunk_length, working_memory // 2 // (max_waiting + workers) // frame_bytes), 1)
+    
+    chunks = []
+    for chunk_start in range(0, len(frame_timestamps), chunk_length):
+        previous_timestamp = frame_timestamps[chunk_start - 1] if chunk_start > 0 else None
+        chunks.append((frame_timestamps[chunk_start:chunk_start + chunk_length], previous_timestamp, x1, y1, x2, y2) + chunk_options)
+    
+    pool = multiprocessing.Pool(workers, InitRenderWorker, (base_pixels, pixels_diffs, replay_chunk_size))
+    try:
+        #only max_waiting chunks are handed out ahead of the one being written, so finished chunks can't pile up
+        #waiting their turn when writing is slower than rendering
+        waiting = collections.deque()
+        for chunk in chunks:
+            waiting.append(pool.apply_async(render_chunk, (chunk,)))
+            if len(waiting) >= max_waiting:
+                result, worker_metrics = waiting.popleft().get()
+                metrics.merge(worker_metrics)
+                yield result
+        while waiting:
+            result, worker_metrics = waiting.popleft().get()
+            metrics.merge(worker_metrics)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def GetFixedFrameTimestamps(start_timestamp, end_timestamp, delay):
+    #a frame every delay seconds from the start, up to the end
+    return list(range(start_timestamp, end_timestamp + 1, delay))
+
+def GetRegionEditTimestamps(x1, y1, x2, y2, start_timestamp, end_timestamp, pixels_diffs):
+    #sorted timestamps of the region's diffs after start_timestamp up to end_timestamp. The whole board is a slice of
+    #the sweep, a crop is one contiguous run of the pixel major store per column
+    if (x1, y1, x2, y2) == (0, 0, board_size - 1, board_size - 1):
+        return numpy.asarray(pixels_diffs.sweep_timestamps[pixels_diffs.getSweepPosition(start_timestamp):pixels_diffs.getSweepPosition(end_timestamp)])
+    
+    timestamps = []
+    for x in range(x1, x2 + 1):
+        start, end = int(pixels_diffs.offsets[x * board_size + y1]), int(pixels_diffs.offsets[x * board_size + y2 + 1])
+        column_timestamps = numpy.asarray(pixels_diffs.timestamps[start:end])
+        timestamps.append(column_timestamps[(column_timestamps > start_timestamp) & (column_timestamps <= end_timestamp)])
+    
+    return numpy.sort(numpy.concatenate(timestamps))
+
+def GetDensityFrameTimestamps(start_timestamp, end_timestamp, number_of_frames, edit_timestamps):
+    #frames placed so there's about the same number of edits between each one, busy stretches get lots of frames and
+    #quiet ones hardly any. The first frame is at the start and the last at the end, frames that land on the same
+    #second are merged so there can be fewer than number_of_frames
+    if number_of_frames < 1:
+        raise ValueError("Need at least 1 frame")
+    if number_of_frames == 1:
+        return [end_timestamp]
+    
+    ranks = numpy.ceil(numpy.linspace(0, len(edit_timestamps), number_of_frames)[1:-1]).astype(numpy.int64)
+    middle = numpy.asarray(edit_timestamps)[numpy.clip(ranks - 1, 0, None)] if len(edit_timestamps) else []
+    
+    return [int(timestamp) for timestamp in numpy.unique(numpy.concatenate(([start_timestamp], middle, [end_timestamp])))]
+
+def GeneratePNGSequence(sequence_timestamp, length_sequence, length_step, x1, y1, x2, y2, base_pixels, pixels_diffs, out_path = None, enlarge = 1, workers = 1, scale = 1):
     logging.info("Started generating PNG Sequence")
 
     if out_path is None:
         out_path = os.path.join(os.getcwd(), "seq_" + str(x1) + "_" + str(y1) + "_" + str(x2) + "_" + str(y2))
     
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    
+    frame_timestamps = [sequence_timestamp + (index * length_step) for index in range(length_sequence)]
+    
     bar = ProgressBarWrapper("Generating PNGs: ", 1, length_sequence)
     
-    for index in range(length_sequence):
-        GeneratePNG(sequence_timestamp + (index * length_step), x1, y1, x2, y2, base_pixels, pixels_diffs, out_path, str(sequence_timestamp + (index * length_step)) + ".png")
-        bar.update()
+    if workers > 1:
+        for frames_saved in RenderChunksInParallel(RenderPNGChunk, frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, workers, (enlarge, scale, out_path)):
+            for index in range(frames_saved):
+                bar.update()
+    else:
+        for frame_timestamp, canvas in ReplayFrames(frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, scale):
+            SaveCanvasAsPNG(canvas, os.path.join(out_path, str(frame_timestamp) + ".png"), enlarge)
+            bar.update()
     
     bar.finish()
         
     logging.info("Finished generating PNG Sequence")
 
-def GenerateGif(sequence_timestamp, length_sequence, length_step, x1, y1, x2, y2, base_pixels, pixels_diffs):
+def GenerateGif(sequence_timestamp, length_sequence, length_step, x1, y1, x2, y2, base_pixels, pixels_diffs, enlarge = 1, delta_frames = False, workers = 1, scale = 1, frame_timestamps = None):
+    #frames are every length_step seconds unless frame_timestamps gives them, e.g. from GetDensityFrameTimestamps
     logging.info("Started generating Gif")
-    #create temp folder to hold intermediate pngs
-    temp_dir = tempfile.TemporaryDirectory()
-    logging.info("Created temp directory to hold intermediate PNGs: " + temp_dir.name)
-    GeneratePNGSequence(sequence_timestamp, length_sequence, length_step, x1, y1, x2, y2, base_pixels, pixels_diffs, temp_dir.name)
-    
-    frames = []
     
-    for root, dirs, filenames in os.walk(temp_dir.name):
-        for filename in filenames:
-            if filename.endswith(".png"):
-                frames.append(imageio.imread(os.path.join(temp_dir.name, filename)))
-                
-    kargs = { 'fps' : 60.0 }
+    if frame_timestamps is None:
+        frame_timestamps = [sequence_timestamp + (index * length_step) for index in range(length_sequence)]
+    length_sequence = len(frame_timestamps)
     
     filename = str(sequence_timestamp) + "_" + str(x1) + "_" + str(y1) + "_" + str(x2) + "_" + str(y2) + "_" + str(length_sequence) + ".gif"
     
-    imageio.mimsave(filename, frames, 'GIF-PIL', **kargs)
+    #frames go straight from the replay into the gif in timestamp order, nothing is held on to or written to disk
+    gif = GifWriter(filename, GetScaledLength(x2 - x1 + 1, scale) * enlarge, GetScaledLength(y2 - y1 + 1, scale) * enlarge, gif_frame_duration, delta_frames)
+    
+    bar = ProgressBarWrapper("Generating Gif frames: ", 1, length_sequence)
+    try:
+        if workers > 1:
+            for encoded_frames in RenderChunksInParallel(RenderGifChunk, frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, workers, (enlarge, scale, delta_frames),
+                                                         gif.width * gif.height):
+                for frame_bytes in encoded_frames:
+                    gif.appendEncoded(frame_bytes)
+                    bar.update()
+        else:
+            for frame_timestamp, canvas in ReplayFrames(frame_timestamps, x1, y1, x2, y2, base_pixels, pixels_diffs, scale):
+                gif.append(EnlargeCanvas(canvas, enlarge))
+                bar.update()
+    finally:
+        gif.close()
     
-    logging.info("Finished generating Gif")
+    bar.finish()
+    
+    logging.info("Finished generating Gif: " + filename + ", " + str(gif.frame_count) + " of " + str(length_sequence) + " frames were different")
+
+def LoadBatchJobs(path):
+    #the job file is a JSON list of jobs, each one takes the same values as the command line: x1, y1, x2, y2 (1-1000),
+    #timestamp and delay, plus optional end, frames, enlarge, scale, delta_frames, format ("gif" or "png") and output
+    job_keys = set(["x1", "y1", "x2", "y2", "timestamp", "delay", "end", "frames", "enlarge", "scale", "delta_frames", "format", "output"])
+    job_types = { 'delta_frames' : bool, 'format' : str, 'output' : str }
+    
+    with open(path) as job_file:
+        job_specs = json.load(job_file)
+    
+    if not isinstance(job_specs, list) or len(job_specs) == 0:
+        raise ValueError("Job file has to be a list of jobs")
+    
+    jobs = []
+    for number, spec in enumerate(job_specs, 1):
+        try:
+            if not isinstance(spec, dict):
+                raise ValueError("job isn't an object")
+            if not set(spec) <= job_keys:
+                raise ValueError("unknown job settings: " + ", ".join(sorted(set(spec) - job_keys)))
+            for key, value in spec.items():
+                #bools are ints in python, so they're checked for separately
+                expected = job_types.get(key, int)
+                if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+                    raise ValueError(key + " has to be " + { int : "a whole number", bool : "true or false", str : "a string" }[expected])
+            
+            x1, y1, x2, y2 = spec.get("x1", 1), spec.get("y1", 1), spec.get("x2", board_size), spec.get("y2", board_size)
+            timestamp, delay = spec.get("timestamp", min_timestamp), spec.get("delay", 60)
+            if delay < 1:
+                raise ValueError("Delay has to be at least 1 second")
+            ValidateArgs(x1, y1, x2, y2, timestamp, delay)
+            
+            #default is frames right up to the end, which is the end of the archive unless it's given
+            end = spec.get("end", max_timestamp)
+            if end <= timestamp or end > max_timestamp:
+                raise ValueError("End has to be after timestamp and no later than " + str(max_timestamp))
+            frame_timestamps = GetFixedFrameTimestamps(timestamp, end, delay)
+            frames = spec.get("frames", len(frame_timestamps))
+            if frames < 1:
+                raise ValueError("Need at least 1 frame")
+            if frames > len(frame_timestamps):
+                raise ValueError(str(frames) + " frames every " + str(delay) + " seconds go past end, there's only room for " + str(len(frame_timestamps)))
+            if spec.get("enlarge", 1) < 1:
+                raise ValueError("Enlarge factor has to be 1 or more")
+            if spec.get("scale", 1) not in (1,) + pyramid_scales:
+                raise ValueError("Scale has to be 1, 2, 4 or 8")
+            if spec.get("format", "gif") not in ("gif", "png"):
+                raise ValueError("Format has to be gif or png")
+        except ValueError as error:
+            raise ValueError("job " + str(number) + ": " + str(error))
+        
+        #-1 for array index
+        jobs.append(BatchJob(x1 - 1, y1 - 1, x2 - 1, y2 - 1, frame_timestamps[:frames],
+                             spec.get("enlarge", 1), spec.get("delta_frames", False), spec.get("output"), spec.get("format", "gif"), spec.get("scale", 1)))
+    
+    outputs = [job.output for job in jobs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Jobs can't write to the same output")
+    
+    return jobs
+
+def GenerateBatch(jobs, base_pixels, pixels_diffs):
+    #every job's frames are crops of one replay of the whole board, so the diffs are read and applied once
+    #however many jobs there are, each job just gets the board handed to it at its own frame timestamps
+    logging.info("Started generating batch of " + str(len(jobs)) + " jobs")
+    
+    jobs_by_timestamp = {}
+    for job in jobs:
+        for frame_timestamp in job.frame_timestamps:
+            jobs_by_timestamp.setdefault(frame_timestamp, []).append(job)
+    
+    bar = ProgressBarWrapper("Generating batch frames: ", 1, sum(len(job.frame_timestamps) for job in jobs))
+    
+    for job in jobs:
+        job.start()
+    try:
+        for frame_timestamp, board in ReplayFrames(sorted(jobs_by_timestamp), 0, 0, board_size - 1, board_size - 1, base_pixels, pixels_diffs):
+            for job in jobs_by_timestamp[frame_timestamp]:
+                job.addFrame(frame_timestamp, board)
+                bar.update()
+    finally:
+        for job in jobs:
+            job.close()
+    
+    bar.finish()
+    
+    logging.info("Finished generating batch: " + ", ".join(job.output for job in jobs))
 
 if __name__ == '__main__':
 
@@ -501,30 +1966,99 @@ if __name__ == '__main__':
     
     try:
         ValidateArgs(args.x1, args.y1, args.x2, args.y2, args.timestamp, args.delay)
+        if args.jobs is not None:
+            #batches take their frame and output settings from the job file and render in this process
+            job_options = [option for option, value, default in (("--end", args.end, max_timestamp), ("--frames", args.frames, None), ("--enlarge", args.enlarge, False),
+                                                                 ("--enlarge-factor", args.enlarge_factor, None), ("--scale", args.scale, 1), ("--delta-frames", args.delta_frames, False)) if value != default]
+            if job_options:
+                raise ValueError(", ".join(job_options) + " can't be used with --jobs, each job gets those from the job file")
+            if args.schedule != "fixed":
+                raise ValueError("--schedule density can't be used with --jobs, jobs only have fixed frames")
+            if args.workers != 1:
+                raise ValueError("--workers can't be used with --jobs, batches render in one process")
+        if args.end <= args.timestamp or args.end > max_timestamp:
+            raise ValueError("End has to be after timestamp and no later than " + str(max_timestamp))
+        if args.frames is not None and args.schedule != "density":
+            raise ValueError("--frames only works with --schedule density, fixed frames are set by delay and end")
+        if args.frames is not None and args.frames < 1:
+            raise ValueError("Need at least 1 frame")
+        if args.enlarge_factor is not None and args.enlarge_factor < 1:
+            raise ValueError("Enlarge factor has to be 1 or more")
+        if args.workers < 1:
+            raise ValueError("Need at least 1 worker")
+        if args.max_memory is not None:
+            SetMemoryLimit(ParseByteSize(args.max_memory), args.workers)
     except ValueError as error:
         logging.critical("Argument not valid: " + str(error))
         exit("Argument not valid: " + str(error))
     
+    jobs = None
+    if args.jobs is not None:
+        try:
+            jobs = LoadBatchJobs(args.jobs)
+        except (ValueError, IOError) as error:
+            logging.critical("Job file not valid: " + str(error))
+            exit("Job file not valid: " + str(error))
+    
     #-1 for array index
     args.x1 -= 1
     args.y1 -= 1
     args.x2 -= 1
     args.y2 -= 1
     
-    number_of_steps = (max_timestamp - min_timestamp) // args.delay  
+    #--enlarge on its own is the original 4 times, --enlarge-factor picks any other
+    enlarge = args.enlarge_factor or (4 if args.enlarge else 1)
+    
+    #frames start at the requested timestamp, not the start of the archive
+    frame_timestamps = GetFixedFrameTimestamps(args.timestamp, args.end, args.delay)
  
-    try:
-        ValidateSQLiteTables()
-    except ValueError as error:
-        logging.warn("SQLite tables need to be rebuilt, this should only happen once")
-        print("SQLite tables need to be rebuilt, this should only happen once") 
-        DropAllTables()
-        PopulateSQLiteWithBasePixels()
-        PopulateSQLiteWithPixelDiffs()
+    store_files = [os.path.join(store_path, name + ".npy") for name in ("timestamps", "colours", "offsets", "sweep_timestamps", "sweep_pixels", "sweep_colours")]
+    keyframe_files = [os.path.join(store_path, name + ".npy") for name in ("keyframes", "keyframe_positions")]
+    keyframe_settings = { 'diff_interval' : args.keyframe_diffs, 'seconds_interval' : args.keyframe_seconds }
+    
+    def CountSQLiteRows():
+        conn = sqlite3.connect('PlaceData.db')
+        counts = { 'pixel_diffs' : conn.execute("SELECT COUNT(*) FROM pixel_diffs").fetchone()[0] }
+        conn.close()
+        return counts
+    
+    #both builds pick up where they left off, only what's changed or new in base.png and diffs.bin gets written
+    EnsureBuilt("base", ["base.png"], [base_path], ValidateBaseBoard, BuildBaseBoard)
+    
+    if jobs is None and (args.x2 - args.x1 + 1) * (args.y2 - args.y1 + 1) < region_load_max_area:
+        #small crops only load the rows inside the crop and gif time window, they don't need the store or keyframes.
+        #They're the only thing that reads the pixel_diffs table, so it isn't built for anything else
+        EnsureBuilt("sqlite", ["diffs.bin"], ['PlaceData.db'], ValidateSQLiteTables, PopulateSQLiteWithPixelDiffs, counts = CountSQLiteRows)
+        base_pixels, diff_pixels = LoadRegionFromSQLite(args.x1, args.y1, args.x2, args.y2, args.timestamp, args.end)
+    else:
+        EnsureBuilt("store", ["diffs.bin"], store_files, ValidatePixelDiffStore, UpdatePixelDiffStore,
+                    counts = lambda: { 'diffs' : len(LoadDiffPixelsIntoMemory()) })
+        
+        diff_pixels = LoadDiffPixelsIntoMemory()
+        
+        EnsureBuilt("keyframes", ["diffs.bin", "base.png"], keyframe_files,
+                    lambda: ValidateKeyframeIndex(diff_pixels, args.keyframe_diffs, args.keyframe_seconds),
+                    lambda: UpdateKeyframeIndex(diff_pixels, args.keyframe_diffs, args.keyframe_seconds),
+                    keyframe_settings, lambda: { 'keyframes' : len(LoadKeyframeIndex()) })
+        diff_pixels.keyframes = LoadKeyframeIndex()
         
+        base_pixels = LoadBasePixelsIntoMemory()
     
-    diff_pixels = LoadDiffPixelsIntoMemory()
-    base_pixels = LoadBasePixelsIntoMemory()
-    GenerateGif(args.timestamp, number_of_steps, args.delay, args.x1, args.y1, args.x2, args.y2, base_pixels, diff_pixels)
+    if args.schedule == "density" and jobs is None:
+        edit_timestamps = GetRegionEditTimestamps(args.x1, args.y1, args.x2, args.y2, args.timestamp, args.end, diff_pixels)
+        frame_timestamps = GetDensityFrameTimestamps(args.timestamp, args.end, args.frames or len(frame_timestamps), edit_timestamps)
+        logging.info("Scheduled " + str(len(frame_timestamps)) + " frames over " + str(len(edit_timestamps)) + " edits")
+    
+    if jobs is not None:
+        with metrics.span("total.batch"):
+            GenerateBatch(jobs, base_pixels, diff_pixels)
+    else:
+        with metrics.span("total.gif"):
+            GenerateGif(args.timestamp, len(frame_timestamps), args.delay, args.x1, args.y1, args.x2, args.y2, base_pixels, diff_pixels,
+                        enlarge, args.delta_frames, args.workers, args.scale, frame_timestamps)
+    
+    metrics.log()
+    if args.metrics is not None:
+        metrics.dump(args.metrics)
          
     logging.info("Finished")
@@ -0,0 +1,284 @@
+'''
+Local HTTP server for r/place board states, loads the pixel diff store once and renders frames and tiles on request
+
+Usage:
+    > server.py --port 8000 --cache-size 256M
+    > curl "http://127.0.0.1:8000/frame?t=1491073260&x1=400&y1=400&x2=600&y2=600&enlarge=2" > frame.png
+    > curl "http://127.0.0.1:8000/tile?t=1491073260&tx=1&ty=2" > tile.png
+    > curl "http://127.0.0.1:8000/tile?t=1491073260&tx=0&ty=0&scale=4" > zoomed_out_tile.png
+'''
+import makegif
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import io
+import json
+import logging
+import threading
+import urllib.parse
+
+
+tile_pixels = 256 #tiles are tile_pixels x tile_pixels board pixels, the ones on the right and bottom edge are cut off by the board
+max_enlarge = 16 #biggest enlarge factor a request can ask for
+max_image_pixels = 4096 * 4096 #biggest image a request can ask for, after scaling
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(prog='server.py', description="Serve r/place frames and tiles over HTTP, run makegif.py first to build the pixel diff store")
+
+    parser.add_argument("--host", help="Address to listen on, default: 127.0.0.1.", default="127.0.0.1")
+    parser.add_argument("--port", type = int, help="Port to listen on, default: 8000.", default=8000)
+    parser.add_argument("--cache-size", help="Memory to keep encoded frames and tiles in, default: 256M.", default="256M")
+    parser.add_argument("--threads", type = int, help="Number of threads rendering at once, default: 4.", default=4)
+
+    return parser.parse_args()
+
+class NotFound(Exception):
+    #path that isn't one of the server's endpoints, kept apart from KeyErrors and IndexErrors thrown while rendering
+    pass
+
+class RenderCache:
+    #least recently used cache of encoded images, evicts by total size in bytes instead of number of entries
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                makegif.metrics.count("cache.misses")
+                return None
+            self.entries.move_to_end(key)
+            makegif.metrics.count("cache.hits")
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                makegif.metrics.count("cache.evictions")
+
+    def getStats(self):
+        counters = makegif.metrics.snapshot()['counters']
+        hits = counters.get("cache.hits", 0)
+        misses = counters.get("cache.misses", 0)
+        return { 'entries' : len(self.entries),
+                 'bytes' : self.size,
+                 'max_bytes' : self.max_bytes,
+                 'hits' : hits,
+                 'misses' : misses,
+                 'evictions' : counters.get("cache.evictions", 0),
+                 'hit_rate' : hits / (hits + misses) if hits + misses else None }
+
+def EncodePNG(canvas, enlarge = 1):
+    png_file = io.BytesIO()
+    makegif.GetPaletteImage(canvas, enlarge).save(png_file, "PNG")
+    makegif.metrics.count("frames.png")
+    return png_file.getvalue()
+
+def GetIntParameter(query, name, default = None):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise ValueError("Missing parameter: " + name)
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ValueError("Parameter " + name + " has to be a whole number")
+
+def GetScaleParameter(query):
+    #zooms out like makegif.py --scale, enlarge is what makes images bigger
+    scale = GetIntParameter(query, "scale", 1)
+    if scale != 1 and scale not in makegif.pyramid_scales:
+        raise ValueError("Scale has to be 1, " + ", ".join(str(level) for level in makegif.pyramid_scales))
+    return scale
+
+class FrameServer:
+    #renders run on a thread pool so a slow render doesn't hold up other requests, requests for the same image
+    #while it's rendering wait on the one render instead of starting their own
+    def __init__(self, base_pixels, pixels_diffs, cache, threads = 4):
+        self.base_pixels = base_pixels
+        self.pixels_diffs = pixels_diffs
+        self.cache = cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.rendering = {}
+
+    async def render(self, key, function, *args):
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        pending = self.rendering.get(key)
+        if pending is None:
+            pending = asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+            self.rendering[key] = pending
+            pending.add_done_callback(lambda done: self.finishRender(key, done))
+
+        #shielded so one client hanging up doesn't cancel the render for everyone else waiting on it
+        return await asyncio.shield(pending)
+
+    def finishRender(self, key, done):
+        del self.rendering[key]
+        if not done.cancelled() and done.exception() is None:
+            self.cache.put(key, done.result())
+
+    def renderRegion(self, timestamp, x1, y1, x2, y2, enlarge, scale):
+        with makegif.metrics.span("server.render"):
+            canvas = makegif.GetCanvasAt(timestamp, x1, y1, x2, y2, self.base_pixels, self.pixels_diffs)
+            return EncodePNG(makegif.DownsampleCanvas(canvas, scale), enlarge)
+
+    async def getRegion(self, timestamp, x1, y1, x2, y2, enlarge, scale = 1):
+        #x1..y2 are 0 based. Every timestamp between the same two diffs is the same image, so they share a cache entry.
+        #scale picks a pyramid level, each pixel is the most common colour of a scale x scale block
+        if enlarge < 1 or enlarge > max_enlarge:
+            raise ValueError("Enlarge has to be between 1 and " + str(max_enlarge))
+        if makegif.GetScaledLength(x2 - x1 + 1, scale) * makegif.GetScaledLength(y2 - y1 + 1, scale) * enlarge * enlarge > max_image_pixels:
+            raise ValueError("Image would be too big, use a smaller region or enlarge")
+
+        position = self.pixels_diffs.getSweepPosition(timestamp)
+        return await self.render((position, x1, y1, x2, y2, enlarge, scale), self.renderRegion, timestamp, x1, y1, x2, y2, enlarge, scale)
+
+    async def getFrame(self, query):
+        #coordinates are 1-1000 like makegif.py
+        x1 = GetIntParameter(query, "x1", 1)
+        y1 = GetIntParameter(query, "y1", 1)
+        x2 = GetIntParameter(query, "x2", makegif.board_size)
+        y2 = GetIntParameter(query, "y2", makegif.board_size)
+        if not (1 <= x1 <= x2 <= makegif.board_size and 1 <= y1 <= y2 <= makegif.board_size):
+            raise ValueError("Region has to be inside 1-" + str(makegif.board_size) + " with x1 <= x2 and y1 <= y2")
+
+        return await self.getRegion(GetIntParameter(query, "t"), x1 - 1, y1 - 1, x2 - 1, y2 - 1,
+                                    GetIntParameter(query, "enlarge", 1), GetScaleParameter(query))
+
+    async def getTile(self, query):
+        #zoomed out tiles cover scale times as much of the board, so they come out the same size as the others
+        scale = GetScaleParameter(query)
+        tile_x = GetIntParameter(query, "tx")
+        tile_y = GetIntParameter(query, "ty")
+        board_pixels = tile_pixels * scale
+        tiles_across = -(-makegif.board_size // board_pixels)
+        if not (0 <= tile_x < tiles_across and 0 <= tile_y < tiles_across):
+            raise ValueError("Tiles go from 0 to " + str(tiles_across - 1))
+
+        x1 = tile_x * board_pixels
+        y1 = tile_y * board_pixels
+        x2 = min(x1 + board_pixels, makegif.board_size) - 1
+        y2 = min(y1 + board_pixels, makegif.board_size) - 1
+        return await self.getRegion(GetIntParameter(query, "t"), x1, y1, x2, y2, GetIntParameter(query, "enlarge", 1), scale)
+
+    def getMetrics(self):
+        snapshot = makegif.metrics.snapshot()
+        snapshot['cache'] = self.cache.getStats()
+        return json.dumps(snapshot, indent=4, sort_keys=True).encode("utf-8")
+
+    async def respond(self, path, query):
+        if path == "/frame":
+            return "image/png", await self.getFrame(query)
+        if path == "/tile":
+            return "image/png", await self.getTile(query)
+        if path == "/metrics":
+            return "application/json", self.getMetrics()
+        raise NotFound(path)
+
+    async def handle(self, reader, writer):
+        #plain HTTP/1.1 GETs, connections are kept open between requests unless the client asks to close them
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                keep_alive = headers.get("connection", "").lower() != "close" and len(parts) == 3 and parts[2] == "HTTP/1.1"
+
+                if len(parts) != 3 or parts[0] != "GET":
+                    status, content_type, body = "405 Method Not Allowed", "text/plain", b"Only GET is supported"
+                else:
+                    url = urllib.parse.urlsplit(parts[1])
+                    try:
+                        with makegif.metrics.span("server.request"):
+                            content_type, body = await self.respond(url.path, urllib.parse.parse_qs(url.query))
+                        status = "200 OK"
+                    except ValueError as error:
+                        status, content_type, body = "400 Bad Request", "text/plain", str(error).encode("utf-8")
+                    except NotFound:
+                        status, content_type, body = "404 Not Found", "text/plain", b"Try /frame, /tile or /metrics"
+                    except Exception as error:
+                        logging.exception("Render failed for " + parts[1])
+                        status, content_type, body = "500 Internal Server Error", "text/plain", str(error).encode("utf-8")
+
+                    makegif.metrics.count("server.requests")
+
+                writer.write(("HTTP/1.1 " + status + "\r\n" +
+                              "Content-Type: " + content_type + "\r\n" +
+                              "Content-Length: " + str(len(body)) + "\r\n" +
+                              "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+if __name__ == '__main__':
+
+    args = ParseArgs()
+
+    FORMAT = '%(asctime)s - %(message)s'
+    logging.basicConfig(format=FORMAT, filename='place_data.log', level=logging.INFO)
+
+    try:
+        cache = RenderCache(makegif.ParseByteSize(args.cache_size))
+        if args.threads < 1:
+            raise ValueError("Need at least 1 thread")
+    except ValueError as error:
+        exit("Argument not valid: " + str(error))
+
+    try:
+        base_pixels = makegif.LoadBasePixelsIntoMemory()
+        pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    except ValueError as error:
+        exit(str(error) + ", run makegif.py first")
+
+    if pixels_diffs.keyframes is None:
+        print("No keyframe index, renders late in the archive will be slow. Run makegif.py on the whole board to build it")
+
+    frame_server = FrameServer(base_pixels, pixels_diffs, cache, args.threads)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_server(frame_server.handle, args.host, args.port))
+    print("Serving on http://" + args.host + ":" + str(args.port) + "/frame, /tile and /metrics")
+    logging.info("Server started on " + args.host + ":" + str(args.port))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        makegif.metrics.log()
+        logging.info("Server stopped")
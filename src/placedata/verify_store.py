@@ -0,0 +1,206 @@
+'''
+Checks that the ways makegif.py can build the pixel diff store and keyframes all come out the same, against a synthetic
+archive so it doesn't need the real diffs.bin. Run it after changing any of the store or keyframe building code
+
+Usage:
+    > verify_store.py --diffs 300000
+'''
+import makegif
+import benchmark
+import numpy
+import os
+import shutil
+import logging
+import argparse
+
+
+def ParseArgs():
+    parser = argparse.ArgumentParser(prog='verify_store.py', description="Check that appended, batched and from scratch pixel diff stores and keyframes are identical")
+
+    parser.add_argument("--diffs", type = int, help="Number of pixel diffs in the synthetic archive, default: 300000.", default=300000)
+    parser.add_argument("--appends", type = int, help="Number of times diffs get appended to diffs.bin in the append check, default: 3.", default=3)
+    parser.add_argument("--keyframe-diffs", type = int, help="Number of diffs between keyframes, small so there are plenty of them to reuse, default: 20000.", default=20000)
+    parser.add_argument("--batches", type = int, help="Roughly how many batches the batched store build is split into, default: 10.", default=10)
+    parser.add_argument("--seed", type = int, help="Random seed for the synthetic archive, default: 0.", default=0)
+    parser.add_argument("--workdir", help="Folder to build everything in, emptied first, default: verify_data.", default="verify_data")
+
+    return parser.parse_args()
+
+def GetStoreFiles():
+    return [os.path.join(makegif.store_path, name + ".npy") for name in ("timestamps", "colours", "offsets", "sweep_timestamps", "sweep_pixels", "sweep_colours")]
+
+def GetKeyframeFiles():
+    return [os.path.join(makegif.store_path, name + ".npy") for name in ("keyframes", "keyframe_positions")]
+
+def EnsureBuilt(diff_interval):
+    #the same steps as a whole board makegif.py run, so appends go through the manifest like they do there
+    makegif.EnsureBuilt("base", ["base.png"], [makegif.base_path], makegif.ValidateBaseBoard, makegif.BuildBaseBoard)
+    makegif.EnsureBuilt("store", ["diffs.bin"], GetStoreFiles(), makegif.ValidatePixelDiffStore, makegif.UpdatePixelDiffStore)
+
+    pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+    makegif.EnsureBuilt("keyframes", ["diffs.bin", "base.png"], GetKeyframeFiles(),
+                        lambda: makegif.ValidateKeyframeIndex(pixels_diffs, diff_interval, None),
+                        lambda: makegif.UpdateKeyframeIndex(pixels_diffs, diff_interval, None),
+                        { 'diff_interval' : diff_interval, 'seconds_interval' : None })
+
+def LoadArrays(paths):
+    #{file name: array} read in full, so a bad .npy header fails here rather than comparing equal by accident
+    return dict((os.path.basename(path), numpy.load(path)) for path in paths)
+
+def CompareArrays(expected, actual):
+    #list of differences between two LoadArrays results, empty when they're identical
+    differences = []
+    for name in sorted(set(expected) | set(actual)):
+        if name not in expected or name not in actual:
+            differences.append(name + " is missing from one of them")
+        elif expected[name].dtype != actual[name].dtype or expected[name].shape != actual[name].shape:
+            differences.append("{0}: {1} {2} against {3} {4}".format(name, expected[name].dtype, expected[name].shape, actual[name].dtype, actual[name].shape))
+        elif not numpy.array_equal(expected[name], actual[name]):
+            differences.append(name + ": first difference at " + str(numpy.argmax((expected[name] != actual[name]).ravel())))
+    return differences
+
+def StartCheck(check_dir, records):
+    #fresh folder with its own diffs.bin and a copy of the base board, nothing carries over between checks
+    os.makedirs(check_dir)
+    shutil.copy("base.png", check_dir)
+    records.tofile(os.path.join(check_dir, "diffs.bin"))
+    os.chdir(check_dir)
+    makegif.working_memory = None
+    makegif.metrics.reset()
+
+def BuildFromScratch(check_dir, records, diff_interval):
+    StartCheck(check_dir, records)
+    try:
+        EnsureBuilt(diff_interval)
+        return LoadArrays(GetStoreFiles() + GetKeyframeFiles())
+    finally:
+        os.chdir("..")
+
+def BuildByAppending(check_dir, records, diff_interval, appends):
+    #builds from the first part of diffs.bin, then appends the rest a piece at a time and updates after each one.
+    #Every piece but the last stops part way through a record, like a download that's still going.
+    #Returns the arrays and anything that was rebuilt when it should only have been added to
+    parts = numpy.array_split(records, appends + 1)
+    StartCheck(check_dir, parts[0])
+    try:
+        EnsureBuilt(diff_interval)
+        rebuilt = []
+        data = b"".join(part.tobytes() for part in parts[1:])
+        ends = numpy.cumsum([len(part) * makegif.diff_record_dtype.itemsize for part in parts[1:]]) - 7
+        ends[-1] += 7
+        written = 0
+        for number, end in enumerate(ends.tolist(), 1):
+            with open("diffs.bin", "ab") as diffs_file:
+                diffs_file.write(data[written:end])
+            written = end
+            makegif.metrics.reset()
+            EnsureBuilt(diff_interval)
+            spans = makegif.metrics.snapshot()['spans']
+            rebuilt += ["append " + str(number) + " rebuilt the " + name for name, span in (("store", "store.build"), ("keyframes", "keyframes.build")) if span in spans]
+        return LoadArrays(GetStoreFiles() + GetKeyframeFiles()), rebuilt
+    finally:
+        os.chdir("..")
+
+def BuildStoreInMemoryAndInBatches(check_dir, records, batches):
+    #(in memory arrays, batched arrays) for the same diffs.bin, the batched build is forced by a small enough memory limit
+    StartCheck(check_dir, records)
+    try:
+        makegif.BuildPixelDiffStore()
+        in_memory = LoadArrays(GetStoreFiles())
+
+        makegif.working_memory = len(records) * makegif.store_batch_bytes_per_diff // batches
+        if len(records) * makegif.store_bytes_per_diff <= makegif.working_memory:
+            raise ValueError("Too few diffs to force a batched store build")
+        shutil.rmtree(makegif.store_path)
+        makegif.BuildPixelDiffStore()
+        return in_memory, LoadArrays(GetStoreFiles())
+    finally:
+        makegif.working_memory = None
+        os.chdir("..")
+
+def CompareRegionLoads(check_dir, records, regions):
+    #small crops are loaded from SQLite instead of the store, renders and point lookups across each region's time
+    #window have to come out the same both ways. Returns the ones that don't
+    StartCheck(check_dir, records)
+    try:
+        makegif.BuildBaseBoard()
+        makegif.PopulateSQLiteWithPixelDiffs()
+        makegif.BuildPixelDiffStore()
+        base_pixels = makegif.LoadBasePixelsIntoMemory()
+        pixels_diffs = makegif.LoadDiffPixelsIntoMemory()
+        random = numpy.random.RandomState(len(records))
+        
+        differences = []
+        for x1, y1, x2, y2, start_timestamp, end_timestamp in regions:
+            name = "({0}, {1}) to ({2}, {3}) ".format(x1, y1, x2, y2)
+            region_base_pixels, region_pixels_diffs = makegif.LoadRegionFromSQLite(x1, y1, x2, y2, start_timestamp, end_timestamp)
+            for timestamp in numpy.linspace(start_timestamp, end_timestamp, 8).astype(numpy.int64).tolist():
+                expected = makegif.GetCanvasAt(timestamp, x1, y1, x2, y2, base_pixels, pixels_diffs)
+                actual = makegif.GetCanvasAt(timestamp, x1, y1, x2, y2, region_base_pixels, region_pixels_diffs)
+                if not numpy.array_equal(expected, actual):
+                    differences.append(name + "renders " + str(int((expected != actual).sum())) + " pixels differently at " + str(timestamp))
+            
+            timestamps = random.randint(start_timestamp, end_timestamp + 1, 10000)
+            xs = random.randint(x1, x2 + 1, len(timestamps))
+            ys = random.randint(y1, y2 + 1, len(timestamps))
+            wrong = (makegif.GetPixelColours(timestamps, xs, ys, base_pixels, pixels_diffs) !=
+                     makegif.GetPixelColours(timestamps, xs, ys, region_base_pixels, region_pixels_diffs)).sum()
+            if wrong:
+                differences.append(name + "looks up " + str(int(wrong)) + " of " + str(len(timestamps)) + " pixel colours differently")
+        return differences
+    finally:
+        os.chdir("..")
+
+def Report(name, differences):
+    if differences:
+        for difference in differences:
+            print("FAILED " + name + ": " + difference)
+    else:
+        print("ok     " + name)
+    return not differences
+
+if __name__ == '__main__':
+
+    args = ParseArgs()
+
+    if args.diffs < 1000 * args.batches or args.appends < 1:
+        exit("Argument not valid: need at least 1000 diffs per batch and 1 append")
+
+    makegif.silent = True
+    #small enough that merging appended diffs into the store goes over plenty of chunk boundaries
+    makegif.replay_chunk_size = max(args.diffs // 20, 1000)
+
+    if os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+    print("Generating synthetic archive with " + str(args.diffs) + " diffs in " + args.workdir)
+    benchmark.GenerateSyntheticArchive(args.workdir, args.diffs, seed = args.seed)
+    os.chdir(args.workdir)
+    logging.basicConfig(format='%(asctime)s - %(message)s', filename='place_data.log', level=logging.INFO)
+
+    records = numpy.fromfile("diffs.bin", dtype=makegif.diff_record_dtype)
+    shuffled = records[numpy.random.RandomState(args.seed).permutation(len(records))]
+
+    passed = True
+
+    full = BuildFromScratch("full", records, args.keyframe_diffs)
+    appended, rebuilt = BuildByAppending("appended", records, args.keyframe_diffs, args.appends)
+    passed &= Report("store and keyframes appended " + str(args.appends) + " times match a full build", CompareArrays(full, appended))
+    passed &= Report("appends only added to the store and reused keyframes", rebuilt)
+
+    in_memory, batched = BuildStoreInMemoryAndInBatches("batched", records, args.batches)
+    passed &= Report("in memory store matches the full build", CompareArrays(dict((name, full[name]) for name in in_memory), in_memory))
+    passed &= Report("batched store matches the in memory one, time ordered diffs.bin", CompareArrays(in_memory, batched))
+
+    in_memory, batched = BuildStoreInMemoryAndInBatches("shuffled", shuffled, args.batches)
+    passed &= Report("batched store matches the in memory one, shuffled diffs.bin", CompareArrays(in_memory, batched))
+
+    #0 based, windows starting later than the archive so the diffs before them get pruned, and crops across tile edges
+    timespan = makegif.max_timestamp - makegif.min_timestamp
+    regions = [(400, 400, 599, 599, makegif.min_timestamp + timespan // 3, makegif.min_timestamp + 2 * timespan // 3),
+               (45, 45, 130, 160, makegif.min_timestamp, makegif.max_timestamp),
+               (0, 900, 99, 999, makegif.min_timestamp + timespan // 2, makegif.max_timestamp)]
+    passed &= Report("small crops loaded from SQLite match the store, time ordered diffs.bin", CompareRegionLoads("region", records, regions))
+    passed &= Report("small crops loaded from SQLite match the store, shuffled diffs.bin", CompareRegionLoads("region_shuffled", shuffled, regions))
+
+    if not passed:
+        exit(1)